@@ -24,7 +24,7 @@ class RLInterface:
         self.is_training = True
         self.env_factory = None
         self.writer = None
-        self.random = False
+        self.actor = None  # optional fast acting path used by play instead of the global network
         self.checkpoint_interval = 50
         atexit.register(self.on_exit)
 
@@ -48,8 +48,8 @@ class RLInterface:
                     env.render()
                     time.sleep(0.03)
 
-                if self.random:
-                    action_index = env.sample_action()
+                if self.actor is not None:
+                    action_index = self.actor.choose_action(state)
                 else:
                     action_index = self.global_network.choose_action(np_torch_wrap(state[None, :]))
 
@@ -78,7 +78,7 @@ class RLInterface:
 
         state = {
             'network': self.global_network.state_dict(),
-            'optimizer': self.optimizer.state_dict(),
+            'optimizer': self.optimizer.state_dict() if self.optimizer is not None else None,
             'max_reward': self.last_max_reward,
             'episode': self.episode
         }
@@ -90,14 +90,19 @@ class RLInterface:
         load_path = os.path.join("checkpoints" if checkpoint else self.save_load_path, self.name + '_' + self.env_name + '.pth')
 
         if os.path.isfile(load_path):
-            state = torch.load(load_path, map_location='cpu')
+            state = self.convert_state(torch.load(load_path, map_location='cpu'))
             self.global_network.load_state_dict(state['network'])
-            self.optimizer.load_state_dict(state['optimizer'])
+            if self.optimizer is not None and state['optimizer'] is not None:
+                self.optimizer.load_state_dict(state['optimizer'])
             self.last_max_reward = state['max_reward']
             self.episode = state['episode']
 
             logging.info(self.logprefix + "Model loaded from %s." % load_path)
 
+    def convert_state(self, state):
+        # overridden by algorithms that can load checkpoints saved with another network layout
+        return state
+
     def init_writer(self):
         self.writer = SummaryWriter(comment="-" + self.name + "_" + self.env_name)
 
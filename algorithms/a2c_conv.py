@@ -12,9 +12,10 @@ import torch.optim as optim
 from torch.distributions import Categorical
 
 from algorithms._interface import RLInterface
+from algorithms.heads import ActorCriticHeads
 
-class Model(nn.Module):
-    def __init__(self, input_shape, n_actions, stack_frames=1):
+class Model(ActorCriticHeads):
+    def __init__(self, input_shape, n_actions, stack_frames=1, fused_heads=False):
         super(Model, self).__init__()
 
         # A shared convolution body
@@ -27,21 +28,7 @@ class Model(nn.Module):
             nn.ReLU()
         )
         
-        conv_out_size = self._get_conv_out(input_shape)
-
-        # First head is returning the policy with probability distribution over actions
-        self.policy = nn.Sequential(
-            nn.Linear(conv_out_size, 512),
-            nn.ReLU(),
-            nn.Linear(512, n_actions)
-        )
-
-        # Second head returns one single number (approximate state's value)
-        self.value = nn.Sequential(
-            nn.Linear(conv_out_size, 512),
-            nn.ReLU(),
-            nn.Linear(512, 1)
-        )
+        self.build_heads(self._get_conv_out(input_shape), n_actions, fused_heads)
 
     def _get_conv_out(self, shape):
         o = self.conv(torch.zeros(1, *shape))
@@ -51,7 +38,8 @@ class Model(nn.Module):
         # Returns a tuple of two tensors: policy and value
         fx = x.float() / 256
         conv_out = self.conv(fx).view(fx.size()[0], -1)
-        return Categorical(self.policy(conv_out)), self.value(conv_out)
+        policy, value = self.forward_heads(conv_out)
+        return Categorical(policy), value
 
 
 class A2C(RLInterface):
@@ -65,7 +53,8 @@ class A2C(RLInterface):
         cuda = torch.cuda.is_available,
         gamma = 0.9, 
         max_eps = 10000,
-        max_eps_length = 1000):
+        max_eps_length = 1000,
+        fused_heads = False):
 
         super(A2C, self).__init__()
 
@@ -81,7 +70,7 @@ class A2C(RLInterface):
         self.gamma = gamma
 
         self.input_shape = self.env.reset()[None, :].shape
-        self.network = Model(self.input_shape, self.env.n_actions, 1).to(self.device)
+        self.network = Model(self.input_shape, self.env.n_actions, 1, fused_heads).to(self.device)
         self.optimizer = optim.Adam(self.network.parameters(), lr=0.001)     
 
         print(self.network)
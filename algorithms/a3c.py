@@ -9,23 +9,29 @@ import numpy as np
 import cv2
 import random
 from algorithms._interface import RLInterface
+from algorithms.encoders import make_encoder, output_size
 from utils import np_torch_wrap, SharedAdam, SharedRMSprop
 import logging
 
 
 class Model(nn.Module):
-    def __init__(self, s_dim, a_dim):
+    def __init__(self, s_dim, a_dim, encoder=None):
         super(Model, self).__init__()
         self.s_dim = s_dim
         self.a_dim = a_dim
-        self.pi1 = nn.Linear(s_dim, 800) # (X, S_DIM) * (S_DIM, 200)
+        # optional shared body, both heads read the raw state by default
+        self.encoder = make_encoder(encoder, (s_dim,)) if encoder else None
+        h_dim = output_size(self.encoder, (s_dim,)) if encoder else s_dim
+        self.pi1 = nn.Linear(h_dim, 800) # (X, S_DIM) * (S_DIM, 200)
         self.pi2 = nn.Linear(800, a_dim)
-        self.v1 = nn.Linear(s_dim, 600)
+        self.v1 = nn.Linear(h_dim, 600)
         self.v2 = nn.Linear(600, 1)
         [(nn.init.normal_(layer.weight, mean=0., std=0.1), nn.init.constant_(layer.bias, 0.)) for layer in [self.pi1, self.pi2, self.v1, self.v2]]
         self.distribution = torch.distributions.Categorical
 
     def forward(self, x):
+        if self.encoder is not None:
+            x = self.encoder(x)
         pi1 = F.relu6(self.pi1(x))
         logits = self.pi2(pi1)
         v1 = F.relu6(self.v1(x))
@@ -68,7 +74,8 @@ class Worker(mp.Process):
         max_length=1000,
         n_s=None,
         n_a=None,
-        render=False):
+        render=False,
+        encoder=None):
 
         super(Worker, self).__init__()
 
@@ -88,7 +95,7 @@ class Worker(mp.Process):
 
         logging.info(self.logprefix + "Instantiating environment...")
         self.env = env_factory()
-        self.local_network = Model(n_s if n_s is not None else self.env.n_obs, n_a if n_a is not None else self.env.n_actions)  # local network
+        self.local_network = Model(n_s if n_s is not None else self.env.n_obs, n_a if n_a is not None else self.env.n_actions, encoder)  # local network
         # synchronize thread-specific parameters Θ' = Θ and Θ'v = Θv
         self.local_network.load_state_dict(global_network.state_dict())
 
@@ -145,7 +152,8 @@ class A3C(RLInterface):
         update_global_delay = 20,
         checkpoint_interval=10,
         max_eps = 10000,
-        max_length = 1000):
+        max_length = 1000,
+        encoder = None):
 
         super(A3C, self).__init__()
 
@@ -165,7 +173,7 @@ class A3C(RLInterface):
         self.save_load_path = save_load_path
         
         # initialize global network
-        self.global_network = Model(env.n_obs, env.n_actions)
+        self.global_network = Model(env.n_obs, env.n_actions, encoder)
         self.global_network.share_memory()  # share the global parameters in multiprocessing
         self.optimizer = SharedRMSprop(self.global_network.parameters(), lr=0.0001)  # global optimizer
 
@@ -195,7 +203,8 @@ class A3C(RLInterface):
                 max_length = 1000, 
                 n_s = None,
                 n_a = env.n_actions,
-                render = render
+                render = render,
+                encoder = encoder
             ) for i in range(n_workers)
         ]
 
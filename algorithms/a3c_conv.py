@@ -3,6 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.multiprocessing as mp
 import gym
+import copy
+import time
+import io
 import os
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,53 +13,42 @@ import cv2
 import logging
 
 from algorithms._interface import RLInterface
+from algorithms.encoders import make_encoder, output_size
+from algorithms.heads import ActorCriticHeads, convert_heads
+from algorithms.quantized import QuantizedModel, QuantizedCopy, refresh_report
 from utils import np_torch_wrap, SharedAdam, SharedRMSprop
 
 
-class Model(nn.Module):
-    def __init__(self, input_shape, n_actions, stack_frames=4):
+class Model(ActorCriticHeads):
+    def __init__(self, input_shape, n_actions, stack_frames=4, fused_heads=False, encoder='nature'):
         super(Model, self).__init__()
 
-        # A shared convolution body
-        self.conv = nn.Sequential(
-            nn.Conv2d(stack_frames, 32, kernel_size=8, stride=4),
-            nn.ReLU(),
-            nn.Conv2d(32, 64, kernel_size=4, stride=2),
-            nn.ReLU(),
-            nn.Conv2d(64, 64, kernel_size=3, stride=1),
-            nn.ReLU()
-        )
-        
-        conv_out_size = int(np.prod(self.conv(torch.zeros(1, *input_shape)).size()))
+        self.n_actions = n_actions
 
-        # First head is returning the policy with probability distribution over actions
-        self.policy = nn.Sequential(
-            nn.Linear(conv_out_size, 512),
-            nn.ReLU(),
-            nn.Linear(512, n_actions)
-        )
+        # A shared convolution body (the frames are stacked on the first dimension of input_shape)
+        self.conv = make_encoder(encoder, input_shape)
 
-        # Second head returns one single number (approximate state's value)
-        self.value = nn.Sequential(
-            nn.Linear(conv_out_size, 512),
-            nn.ReLU(),
-            nn.Linear(512, 1)
-        )
+        self.build_heads(output_size(self.conv, input_shape), n_actions, fused_heads)
 
         self.distribution = torch.distributions.Categorical
 
     def forward(self, x):
         # Returns a tuple of two tensors: policy and value
         fx = x.float() / 256
-        conv_out = self.conv(fx).view(fx.size()[0], -1)
-        return self.policy(conv_out), self.value(conv_out)
+        conv_out = self.conv(fx).reshape(fx.size()[0], -1)  # reshape also handles channels last outputs
+        return self.forward_heads(conv_out)
+
+    def policy_logits(self, x):
+        # Acting only needs the policy head, so the value head is skipped
+        fx = x.float() / 256
+        conv_out = self.conv(fx).reshape(fx.size()[0], -1)
+        return self.forward_policy(conv_out)
 
     def choose_action(self, s):
-        self.eval()
-        logits, _ = self.forward(s)
-        prob = F.softmax(logits, dim=1).data
-        m = self.distribution(prob)
-        return m.sample().numpy()[0]
+        with torch.inference_mode():
+            logits = self.policy_logits(s)
+            # Gumbel-max trick: argmax(logits + Gumbel noise) is a sample of softmax(logits)
+            return np.int64((logits[0] - torch.empty_like(logits[0]).exponential_().log_()).argmax().item())
 
     def loss_func(self, states, actions, target_values):
         self.train()
@@ -75,6 +67,115 @@ class Model(nn.Module):
         return total_loss, value_loss.detach().mean(), policy_loss.detach().mean(), advantage.detach().mean()
 
 
+class QuantizedPolicy(QuantizedModel):
+    """
+    int8 copy of the policy of a Model, only used for acting.
+    Convolutions are statically quantized with activation ranges calibrated on the given states,
+    linear layers are dynamically quantized. refresh() requantizes the weights of the fp32 model.
+    """
+
+    def __init__(self, model, calibration_states):
+        super(QuantizedPolicy, self).__init__(model.conv, copy.deepcopy(model.policy_head()))
+        self.quantize(calibration_states)
+
+    def forward(self, x):
+        return self.heads(self.features(x.float() / 256))
+
+    def refresh(self, model):
+        self.requantize(model.conv, model.policy_head_weights())
+
+
+class Actor:
+    """
+    Batch-1 inference path of a Model, used on the acting hot loop.
+    The traced forward shares the Model parameters, so loading a state dict into the model refreshes it.
+    With quantize, the first calibration_size states are played in fp32, then an int8 QuantizedPolicy
+    kept by a QuantizedCopy is used. refresh() is called after every weight update, the copy is only
+    requantized every refresh_interval of them.
+    """
+
+    def __init__(self, model, input_shape, jit=True, channels_last=True, quantize=False, calibration_size=64,
+                 refresh_interval=10, recalibrate_interval=10):
+        self.model = model
+        self.quantized = QuantizedCopy(QuantizedPolicy, model, calibration_size, refresh_interval, recalibrate_interval) if quantize else None
+
+        # preallocated input and noise buffers, reused on every step
+        self.input = torch.zeros(1, *input_shape)
+        self.noise = torch.zeros(model.n_actions)
+
+        if channels_last:  # NHWC lets oneDNN pick its fast convolution kernels on CPU
+            model.conv.to(memory_format=torch.channels_last)
+            self.input = self.input.contiguous(memory_format=torch.channels_last)
+
+        with torch.no_grad():
+            self.policy_logits = torch.jit.trace_module(model, {'policy_logits': self.input}).policy_logits if jit else model.policy_logits
+
+    def choose_action(self, state):
+        policy_logits = self.policy_logits
+        if self.quantized is not None:
+            self.quantized.observe(torch.from_numpy(np.asarray(state))[None])
+            policy_logits = self.quantized.net or policy_logits
+
+        with torch.inference_mode():
+            self.input.copy_(torch.from_numpy(np.asarray(state)))
+            logits = policy_logits(self.input)[0]
+            # Gumbel-max trick: argmax(logits + Gumbel noise) is a sample of softmax(logits)
+            return np.int64((logits - self.noise.exponential_().log_()).argmax().item())
+
+    def refresh(self, force=False):
+        if self.quantized is not None:
+            self.quantized.refresh(force)
+
+
+def quantization_report(model, states, n_runs=200, update_global_delay=20):
+    """
+    Benchmarks batch-1 acting of the fp32 Actor against its int8 copy on the given states
+    and measures how often both pick the same greedy action.
+    The int8 copy is refreshed after every synchronization, of update_global_delay steps each.
+    """
+    model = copy.deepcopy(model)
+    states = np.asarray(states)
+    fp32_actor = Actor(model, states.shape[1:])
+    int8_actor = Actor(model, states.shape[1:], jit=False, quantize=True, calibration_size=len(states))
+    int8_actor.quantized.observe(torch.from_numpy(states))
+    quantized = int8_actor.quantized.net
+
+    def latency(policy_logits, actor):
+        runs = [states[i % len(states)] for i in range(n_runs)]
+        with torch.inference_mode():
+            start = time.perf_counter()
+            for state in runs:
+                actor.input.copy_(torch.from_numpy(state))
+                policy_logits(actor.input)
+            return (time.perf_counter() - start) / n_runs
+
+    def size(module):
+        buffer = io.BytesIO()
+        torch.save(module.state_dict(), buffer)
+        return buffer.tell()
+
+    fp32_latency = latency(fp32_actor.policy_logits, fp32_actor)
+    int8_latency = latency(quantized, int8_actor)
+
+    with torch.inference_mode():
+        batch = np_torch_wrap(states)
+        fp32_probs = F.softmax(model.policy_logits(batch), dim=1)
+        int8_probs = F.softmax(quantized(batch), dim=1)
+
+    return {
+        "fp32_latency_ms": fp32_latency * 1e3,
+        "int8_latency_ms": int8_latency * 1e3,
+        "speedup": fp32_latency / int8_latency,
+        **refresh_report(int8_actor.quantized, fp32_latency, int8_latency, update_global_delay),
+        "fp32_size_mb": size(nn.ModuleList([model.conv, model.policy_head()])) / 2 ** 20,
+        "int8_size_mb": size(quantized) / 2 ** 20,
+        # fraction of states where both policies agree on the most likely action
+        "greedy_agreement": (fp32_probs.argmax(1) == int8_probs.argmax(1)).float().mean().item(),
+        # mean total variation distance between both action distributions
+        "total_variation": 0.5 * (fp32_probs - int8_probs).abs().sum(1).mean().item()
+    }
+
+
 class Worker(mp.Process):
     def __init__(
         self, 
@@ -90,7 +191,11 @@ class Worker(mp.Process):
         max_length=1000,
         n_s=None,
         n_a=None,
-        render=False):
+        render=False,
+        quantize=False,
+        quantize_refresh=10,
+        fused_heads=False,
+        encoder='nature'):
 
         super(Worker, self).__init__()
 
@@ -98,6 +203,8 @@ class Worker(mp.Process):
         self.name = 'w%i' % worker_name
         self.logprefix = "\033[0;1mWorker %s:\033[0m " % self.name
         self.render = render
+        self.quantize = quantize  # act with an int8 copy of the local network
+        self.quantize_refresh = quantize_refresh  # synchronizations between requantizations of the int8 copy
         self.max_eps = max_eps  # max episodes of all workers
         self.max_length = max_length
         self.update_global_delay = update_global_delay
@@ -112,12 +219,15 @@ class Worker(mp.Process):
         self.env = env_factory()
         env_temp = env_factory()
         env_shape = env_temp.reset().shape
-        self.local_network = Model(n_s if n_s is not None else env_shape, n_a if n_a is not None else self.env.n_actions, self.env.stack_frames)  # local network
+        self.local_network = Model(n_s if n_s is not None else env_shape, n_a if n_a is not None else self.env.n_actions, self.env.stack_frames, fused_heads, encoder)  # local network
         # synchronize thread-specific parameters Θ' = Θ and Θ'v = Θv
         self.local_network.load_state_dict(global_network.state_dict())
+        self.env_shape = env_shape
+        self.actor = None  # traced modules can't be pickled, so the actor is built on the worker process
 
     def run(self):
         logging.info(self.logprefix + "Running...")
+        self.actor = Actor(self.local_network, self.env_shape, quantize=self.quantize, refresh_interval=self.quantize_refresh)
         thread_step = 1  # initialize thread step counter
         while self.global_ep_counter.value < self.max_eps:  # repeat until T < Tmax
             # here we don't reset gradients or synchronize thread-specific parameters with
@@ -136,7 +246,7 @@ class Worker(mp.Process):
                 if self.render and self.name == 'w0':
                     self.env.render()
 
-                action = self.local_network.choose_action(np_torch_wrap(state[None, :]))  # perform At according to local policy
+                action = self.actor.choose_action(state)  # perform At according to local policy
                 new_state, reward, done, _ = self.env.step(action if action < self.env.n_actions else 0)  # receive reward Rt and new state St+1
                 if done: reward = -1
                 episode_reward += reward  # accumulate reward
@@ -150,6 +260,7 @@ class Worker(mp.Process):
                     # perform asynchronous update on global network
                     # send all last states/actions/rewards function to calculate accumulated gradients and push it to the global network
                     loss, mean_value_loss, mean_policy_loss, mean_advantage = self.synchronize(self.local_network, done, new_state, buffer_state, buffer_action, buffer_reward)
+                    self.actor.refresh()  # requantize the acting copy with the synchronized weights, every quantize_refresh syncs
 
                     gradient_updates += 1
                     total_loss += loss
@@ -194,29 +305,33 @@ class A3C(RLInterface):
         checkpoint_interval=10,
         max_eps = 10000,
         max_length = 1000,
-        random = False):
+        quantize = False,
+        quantize_refresh = 10,
+        fused_heads = False,
+        encoder = 'nature'):
 
         super(A3C, self).__init__()
 
         self.name = "A3C_Conv"
         self.logprefix = "\033[0;1mA3C Global: \033[0m"
         self.env_factory = env_factory
-        self.random = random
 
         # init temp env to get it's properties
         logging.info(self.logprefix + "Instantiating environment...")
         env = env_factory[0]() if type(env_factory) is list else env_factory()
         env_shape = env.reset().shape
         self.env_name = env.name  # to save/load
+        self.env_shape = env_shape
         
         # free attributes
         self.checkpoint_interval = checkpoint_interval
         self.render = render
         self.gamma = gamma
+        self.update_global_delay = update_global_delay
         self.save_load_path = save_load_path
         
         # initialize global network
-        self.global_network = Model(env_shape, env.n_actions, env.stack_frames)
+        self.global_network = Model(env_shape, env.n_actions, env.stack_frames, fused_heads, encoder)
         self.global_network.share_memory()  # share the global parameters in multiprocessing
         self.optimizer = SharedRMSprop(self.global_network.parameters(), lr=0.0001)  # global optimizer
 
@@ -226,6 +341,9 @@ class A3C(RLInterface):
         if not skip_load:
             self.load(not play)  # if we want to play we play with the best player, not the last one
 
+        if play and quantize:
+            self.actor = Actor(self.global_network, env_shape, quantize=True)
+
         self.global_ep_counter = mp.Value('i', self.episode)  # this is needed to control workers episode limit
         self.global_ep_reward = mp.Value('d', 0.)  # current episode reward
         self.res_queue = mp.Queue()  # queue to receive workers statistics
@@ -246,7 +364,11 @@ class A3C(RLInterface):
                 max_length = 1000, 
                 n_s = None,
                 n_a = env.n_actions,
-                render = render
+                render = render,
+                quantize = quantize,
+                quantize_refresh = quantize_refresh,
+                fused_heads = fused_heads,
+                encoder = encoder
             ) for i in range(n_workers)
         ]
 
@@ -286,6 +408,54 @@ class A3C(RLInterface):
         [w.join() for w in self.workers]
         
 
+    def convert_state(self, state):
+        """
+        Converts the optimizer state of a checkpoint saved with the other head layout.
+        The network itself is converted by Model.load_state_dict.
+        """
+
+        fused = self.global_network.fused_heads
+        if fused == ('hidden.weight' in state['network']):
+            return state
+
+        # optimizer states are indexed by parameter order, name them to convert them as the network
+        optimizer_state = state['optimizer']
+        old_names = list(state['network'].keys())
+        named_state = {old_names[i]: param_state for i, param_state in optimizer_state['state'].items()}
+        fields = next(iter(named_state.values())).keys()
+        converted = {
+            field: convert_heads({name: param_state[field] for name, param_state in named_state.items()}, fused)
+            for field in fields
+        }
+
+        new_names = list(self.global_network.state_dict().keys())
+        optimizer_state['state'] = {i: {field: converted[field][name] for field in fields} for i, name in enumerate(new_names)}
+        optimizer_state['param_groups'][0]['params'] = list(range(len(new_names)))
+
+        logging.info(self.logprefix + "Converted checkpoint to the %s head layout." % ("fused" if fused else "two-head"))
+        return state
+
+    def quantization_report(self, n_states=256):
+        """
+        Compares the int8 acting copy against the fp32 global network on states of a random agent.
+        """
+
+        logging.info(self.logprefix + "Collecting %d states..." % n_states)
+        env = self.env_factory[0]() if type(self.env_factory) is list else self.env_factory()
+        states = []
+        state = env.reset()
+        while len(states) < n_states:
+            states.append(np.array(state))
+            state, _, done, _ = env.step(env.sample_action())
+            if done:
+                state = env.reset()
+        env.close()
+
+        report = quantization_report(self.global_network, states, update_global_delay=self.update_global_delay)
+        for key, value in report.items():
+            logging.info(self.logprefix + key + ": " + "{0:.4f}".format(value))
+        return report
+
     def sync(self, local_network, done, new_state, buffer_state, buffer_action, buffer_reward):
         """
         Remember: This method is called locally on all worker processes
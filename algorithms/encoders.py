@@ -0,0 +1,141 @@
+import torch
+import torch.nn as nn
+import numpy as np
+import time
+
+
+class ResidualBlock(nn.Module):
+    def __init__(self, channels):
+        super(ResidualBlock, self).__init__()
+        self.conv0 = nn.Conv2d(channels, channels, kernel_size=3, padding=1)
+        self.conv1 = nn.Conv2d(channels, channels, kernel_size=3, padding=1)
+
+    def forward(self, x):
+        out = self.conv0(torch.relu(x))
+        out = self.conv1(torch.relu(out))
+        return x + out
+
+
+def nature(input_shape, stem_padding=0):
+    # Convolution body of the Nature DQN paper (3136 features for 84x84 inputs)
+    return nn.Sequential(
+        nn.Conv2d(input_shape[0], 32, kernel_size=8, stride=4, padding=stem_padding),
+        nn.ReLU(),
+        nn.Conv2d(32, 64, kernel_size=4, stride=2),
+        nn.ReLU(),
+        nn.Conv2d(64, 64, kernel_size=3, stride=1),
+        nn.ReLU()
+    )
+
+
+def impala(input_shape, stem_padding=0, channels=(16, 32, 32)):
+    # Small IMPALA ResNet: each stage is a conv, a strided max pool and two residual blocks
+    layers = []
+    in_channels = input_shape[0]
+    for i, out_channels in enumerate(channels):
+        layers += [
+            nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1 + (stem_padding if i == 0 else 0)),
+            nn.MaxPool2d(kernel_size=3, stride=2, padding=1),
+            ResidualBlock(out_channels),
+            ResidualBlock(out_channels)
+        ]
+        in_channels = out_channels
+    layers.append(nn.ReLU())
+    return nn.Sequential(*layers)
+
+
+def separable(input_shape, stem_padding=0):
+    # Nature DQN layout with depthwise-separable convolutions after the stem (same 3136 features)
+    return nn.Sequential(
+        nn.Conv2d(input_shape[0], 32, kernel_size=8, stride=4, padding=stem_padding),
+        nn.ReLU(),
+        nn.Conv2d(32, 32, kernel_size=4, stride=2, groups=32),
+        nn.Conv2d(32, 64, kernel_size=1),
+        nn.ReLU(),
+        nn.Conv2d(64, 64, kernel_size=3, stride=1, groups=64),
+        nn.Conv2d(64, 64, kernel_size=1),
+        nn.ReLU()
+    )
+
+
+def mlp(input_shape, hidden_size=256):
+    # Fully connected body for vector observations
+    return nn.Sequential(
+        nn.Flatten(),
+        nn.Linear(int(np.prod(input_shape)), hidden_size),
+        nn.ReLU()
+    )
+
+
+ENCODERS = {
+    'nature': nature,
+    'impala': impala,
+    'separable': separable,
+    'mlp': mlp
+}
+
+
+def make_encoder(name, input_shape, **kwargs):
+    if name not in ENCODERS:
+        raise ValueError("Unknown encoder '%s', choose from %s" % (name, list(ENCODERS.keys())))
+    return ENCODERS[name](input_shape, **kwargs)
+
+
+def output_size(encoder, input_shape):
+    with torch.no_grad():
+        return int(np.prod(encoder(torch.zeros(1, *input_shape)).size()))
+
+
+def conv_relu_pairs(encoder):
+    # Names of (conv, relu) pairs that can be fused for quantization, only sequential encoders are supported
+    if not isinstance(encoder, nn.Sequential) or not all(isinstance(m, (nn.Conv2d, nn.ReLU)) for m in encoder):
+        raise ValueError("Only sequential convolution encoders can be quantized")
+    return [[str(i), str(i + 1)] for i in range(len(encoder) - 1)
+            if isinstance(encoder[i], nn.Conv2d) and isinstance(encoder[i + 1], nn.ReLU)]
+
+
+def count_flops(module, input_shape):
+    # Multiply-adds of convolutions and linear layers (x2) for a single input
+    flops = []
+
+    def hook(layer, inputs, output):
+        if isinstance(layer, nn.Conv2d):
+            flops.append(2 * output.numel() * layer.in_channels // layer.groups * int(np.prod(layer.kernel_size)))
+        else:
+            flops.append(2 * layer.in_features * layer.out_features)
+
+    handles = [m.register_forward_hook(hook) for m in module.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    with torch.no_grad():
+        module(torch.zeros(1, *input_shape))
+    [h.remove() for h in handles]
+    return sum(flops)
+
+
+def report(input_shape, names=None, n_runs=200):
+    """
+    Parameter count, FLOPs and batch-1 CPU latency of every encoder for the given input shape.
+    """
+
+    if names is None:  # convolution encoders need image inputs
+        names = ENCODERS.keys() if len(input_shape) == 3 else ['mlp']
+
+    rows = []
+    for name in names:
+        encoder = make_encoder(name, input_shape).eval()
+        x = torch.zeros(1, *input_shape)
+        with torch.inference_mode():
+            for _ in range(10):  # warm up
+                encoder(x)
+            start = time.perf_counter()
+            for _ in range(n_runs):
+                encoder(x)
+            latency = (time.perf_counter() - start) / n_runs
+
+        rows.append({
+            "encoder": name,
+            "params": sum(p.numel() for p in encoder.parameters()),
+            "flops": count_flops(encoder, input_shape),
+            "features": output_size(encoder, input_shape),
+            "latency_ms": latency * 1e3
+        })
+    return rows
@@ -0,0 +1,145 @@
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from torch.nn.utils import vector_to_parameters
+from functools import partial
+import numpy as np
+import logging
+import time
+
+from algorithms._interface import RLInterface
+from algorithms.encoders import make_encoder, output_size
+from algorithms.es.pytorch_es import EvolutionModule
+from algorithms.es.pytorch_es.utils.helpers import make_reward_function
+from utils import np_torch_wrap
+
+
+class Model(nn.Module):
+    def __init__(self, input_shape, n_actions, encoder=None, hidden_size=512):
+        super(Model, self).__init__()
+
+        # convolution body for images, fully connected body for vector observations
+        self.frames = len(input_shape) == 3
+        self.conv = make_encoder(encoder or ('nature' if len(input_shape) == 3 else 'mlp'), input_shape)
+        self.policy = nn.Sequential(
+            nn.Linear(output_size(self.conv, input_shape), hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, n_actions)
+        )
+
+    def forward(self, x):
+        if self.frames:
+            x = x.float() / 256  # frames are in [0, 255], like the A3C
+        x = self.conv(x)
+        return self.policy(x.reshape(x.size(0), -1))
+
+    def choose_action(self, s):
+        # greedy, the exploration comes from the parameter noise
+        with torch.inference_mode():
+            return np.int64(self.forward(s).argmax(1)[0])
+
+
+def get_reward(weights, model, env, max_length, render=False):
+    # weights is a flat parameter vector, the model parameters become views into it (no copy)
+    vector_to_parameters(weights, model.parameters())
+
+    state = env.reset()
+    episode_reward = 0.
+    for _ in range(max_length):
+        if render:
+            env.render()
+        state, reward, terminal, _ = env.step(model.choose_action(np_torch_wrap(state[None, :])))
+        episode_reward += reward
+        if terminal:
+            break
+    return episode_reward
+
+
+class ES(RLInterface):
+    def __init__(
+        self,
+        env_factory,
+        play = False,
+        save_load_path = "trained_models",
+        skip_load = False,
+        render = False,
+        n_workers = mp.cpu_count(),
+        checkpoint_interval = 50,
+        generations = 1000,
+        max_length = 1000,
+        population_size = 50,
+        sigma = 0.02,
+        learning_rate = 0.01,
+        antithetic = False,
+        encoder = None):
+
+        super(ES, self).__init__()
+
+        self.name = "ES"
+        self.logprefix = "\033[0;1mES: \033[0m"
+        self.env_factory = env_factory
+        self.generations = generations
+
+        # init temp env to get it's properties
+        logging.info(self.logprefix + "Instantiating environment...")
+        env = env_factory[0]() if type(env_factory) is list else env_factory()
+        env_shape = env.reset().shape
+        self.env_name = env.name  # to save/load
+        env.close()
+
+        # free attributes
+        self.checkpoint_interval = checkpoint_interval
+        self.render = render
+        self.save_load_path = save_load_path
+
+        model_factory = partial(Model, env_shape, env.n_actions, encoder)
+        self.global_network = model_factory()
+
+        if not play:
+            # candidates are evaluated on processes owning their env and model, they only receive noise offsets;
+            # with a combo, all the candidates of a generation play the same level
+            self.es = EvolutionModule(
+                list(self.global_network.parameters()), None,
+                population_size = population_size,
+                sigma = sigma,
+                learning_rate = learning_rate,
+                threadcount = max(n_workers, 1),
+                reward_factory = partial(make_reward_function, get_reward, model_factory, env_factory, max_length=max_length),
+                processes = True,
+                fitness_shaping = 'rank',
+                optimizer = 'adam',
+                antithetic = antithetic
+            )
+            self.optimizer = self.es.optimizer
+
+        self.init_writer()  # instantiate tensorboard writer
+
+        # load network, optimizer, generation count and max_reward
+        if not skip_load:
+            self.load(not play)  # if we want to play we play with the best player, not the last one
+
+    def run(self):
+        """
+        This method only runs on the main process, every episode of the records is a generation.
+        """
+
+        super(ES, self).run()
+
+        logging.info(self.logprefix + "Evolving %d generations" % self.generations)
+
+        while self.episode < self.generations:
+            start = time.time()
+            rewards = self.es.evolve()
+            self.episode += 1
+
+            self.record(
+                message=self.env_name + "  |  Max: " + "{0:.2f}".format(np.max(rewards)) +
+                "  |  Candidates/s: " + "{0:.2f}".format(len(rewards) / (time.time() - start)),
+                episode=self.episode,
+                reward=float(np.mean(rewards))
+            )
+            self.writer.add_scalar("MaxReward/Generation", np.max(rewards), self.episode)
+            self.writer.add_scalar("Sigma/Generation", self.es.SIGMA, self.episode)
+
+        self.save()
+        self.es.close()
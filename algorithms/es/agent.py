@@ -1,22 +1,21 @@
 import torch.nn as nn
 import torch
 
+from ..encoders import make_encoder, output_size
+
 class Flatten(nn.Module):
     def forward(self, input):
         return input.view(input.size(0), -1)
 
 class Agent:
-    def __init__(self, args):
+    def __init__(self, args, env):
+        input_shape = (args.history_length, 84, 84)
+        encoder = make_encoder(getattr(args, 'encoder', 'nature'), input_shape, stem_padding=1)
         self.model = nn.Sequential(
-            nn.Conv2d(args.history_length, 32, 8, stride=4, padding=1),
-            nn.ReLU(),
-            nn.Conv2d(32, 64, 4, stride=2),
-            nn.ReLU(),
-            nn.Conv2d(64, 64, 3),  #  colocar x = x.view(-1, 3136)
-            nn.ReLU(),
+            encoder,  # nature: 3136 features, as the former hardcoded x.view(-1, 3136)
             Flatten(),
-            nn.Linear(3136, 512),
+            nn.Linear(output_size(encoder, input_shape), 512),
             nn.ReLU(),
-            nn.Linear(512, 6),
+            nn.Linear(512, env.action_space()),
             nn.Softmax(1)
-        )
\ No newline at end of file
+        )
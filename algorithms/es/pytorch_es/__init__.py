@@ -1,2 +1,5 @@
 __version__ = '0.1.1'
-from .strategies.evolution import EvolutionModule
\ No newline at end of file
+from .strategies.evolution import EvolutionModule
+from .strategies.noise import SharedNoiseTable
+from .strategies.batched import BatchedEvaluator
+from .strategies.distributed import DistributedEvolution
@@ -13,13 +13,14 @@ import time
 
 # from evostra import EvolutionStrategy
 from pytorch_es import EvolutionModule
-from pytorch_es.utils.helpers import weights_init
+from pytorch_es.utils.helpers import weights_init, make_reward_function
 import gym
 from gym import logger as gym_logger
 import numpy as np
 import torch
 from torch.autograd import Variable
 import torch.nn as nn
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 
 gym_logger.setLevel(logging.CRITICAL)
 
@@ -46,12 +47,7 @@ if cuda:
     model = model.cuda()
 
 def get_reward(weights, model, render=False):
-    cloned_model = copy.deepcopy(model)
-    for i, param in enumerate(cloned_model.parameters()):
-        try:
-            param.data.copy_(weights[i])
-        except:
-            param.data.copy_(weights[i].data)
+    vector_to_parameters(weights, model.parameters())
 
     env = gym.make("CartPole-v0")
     ob = env.reset()
@@ -64,7 +60,7 @@ def get_reward(weights, model, render=False):
         batch = torch.from_numpy(ob[np.newaxis,...]).float()
         if cuda:
             batch = batch.cuda()
-        prediction = cloned_model(Variable(batch))
+        prediction = model(Variable(batch))
         action = prediction.data.numpy().argmax()
         ob, reward, done, _ = env.step(action)
 
@@ -72,14 +68,16 @@ def get_reward(weights, model, render=False):
 
     env.close()
     return total_reward
-    
+
+
 partial_func = partial(get_reward, model=model)
 mother_parameters = list(model.parameters())
 
 es = EvolutionModule(
     mother_parameters, partial_func, population_size=5, sigma=0.1, 
     learning_rate=0.001, threadcount=15, cuda=cuda, reward_goal=200,
-    consecutive_goal_stopping=10
+    consecutive_goal_stopping=10,
+    reward_factory=partial(make_reward_function, get_reward, partial(copy.deepcopy, model))
 )
 start = time.time()
 final_weights = es.run(400)
@@ -87,6 +85,6 @@ end = time.time() - start
 
 pickle.dump(final_weights, open(os.path.abspath(args.weights_path), 'wb'))
 
-reward = partial_func(final_weights, render=True)
+reward = partial_func(parameters_to_vector(final_weights), render=True)
 print(f"Reward from final weights: {reward}")
 print(f"Time to completion: {end}")
\ No newline at end of file
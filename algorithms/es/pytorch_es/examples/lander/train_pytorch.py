@@ -12,7 +12,7 @@ import time
 
 # from evostra import EvolutionStrategy
 from pytorch_es import EvolutionModule
-from pytorch_es.utils.helpers import weights_init
+from pytorch_es.utils.helpers import weights_init, make_reward_function
 import gym
 from gym import logger as gym_logger
 import numpy as np
@@ -20,6 +20,7 @@ from PIL import Image
 import torch
 from torch.autograd import Variable
 import torch.nn as nn
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 import torchvision
 from torchvision import transforms
 gym_logger.setLevel(logging.CRITICAL)
@@ -48,12 +49,7 @@ if cuda:
 
 def get_reward(weights, model, render=False):
 
-    cloned_model = copy.deepcopy(model)
-    for i, param in enumerate(cloned_model.parameters()):
-        try:
-            param.data.copy_(weights[i])
-        except:
-            param.data.copy_(weights[i].data)
+    vector_to_parameters(weights, model.parameters())
 
     env = gym.make("LunarLander-v2")
     ob = env.reset()
@@ -66,7 +62,7 @@ def get_reward(weights, model, render=False):
         batch = torch.from_numpy(ob[np.newaxis,...]).float()
         if cuda:
             batch = batch.cuda()
-        prediction = cloned_model(Variable(batch))
+        prediction = model(Variable(batch))
         action = prediction.data.numpy().argmax()
         ob, reward, done, _ = env.step(action)
 
@@ -74,6 +70,7 @@ def get_reward(weights, model, render=False):
     env.close()
     return total_reward
 
+
 partial_func = partial(get_reward, model=model)
 mother_parameters = list(model.parameters())
 
@@ -81,10 +78,11 @@ es = EvolutionModule(
     mother_parameters, partial_func, population_size=100,
     sigma=0.01, learning_rate=0.001, decay=0.9999,
     reward_goal=200, consecutive_goal_stopping=10, threadcount=15,
-    cuda=cuda, render_test=True, save_path=os.path.abspath(args.weights_path)
+    cuda=cuda, render_test=True, save_path=os.path.abspath(args.weights_path),
+    reward_factory=partial(make_reward_function, get_reward, partial(copy.deepcopy, model))
 )
 start = time.time()
 final_weights = es.run(4000, print_step=10)
 end = time.time() - start
 
-reward = partial_func(final_weights, render=True)
+reward = partial_func(parameters_to_vector(final_weights), render=True)
@@ -13,7 +13,7 @@ import time
 
 # from evostra import EvolutionStrategy
 from pytorch_es import EvolutionModule
-from pytorch_es.utils.helpers import weights_init
+from pytorch_es.utils.helpers import weights_init, make_reward_function
 import gym
 from gym import logger as gym_logger
 import numpy as np
@@ -21,6 +21,7 @@ from PIL import Image
 import torch
 from torch.autograd import Variable
 import torch.nn as nn
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 import torchvision
 from torchvision import transforms
 gym_logger.setLevel(logging.CRITICAL)
@@ -59,12 +60,7 @@ env = gym.make("SpaceInvaders-ram-v0")
 def get_reward(weights, model, render=False):
     global env
 
-    cloned_model = copy.deepcopy(model)
-    for i, param in enumerate(cloned_model.parameters()):
-        try:
-            param.data = weights[i]
-        except:
-            param.data = weights[i].data
+    vector_to_parameters(weights, model.parameters())
 
     ob = env.reset()
     done = False
@@ -76,7 +72,7 @@ def get_reward(weights, model, render=False):
         batch = torch.from_numpy(ob[np.newaxis,...]).float()
         if cuda:
             batch = batch.cuda()
-        prediction = cloned_model(Variable(batch, volatile=True))
+        prediction = model(Variable(batch, volatile=True))
         action = prediction.data.cpu().numpy().argmax()
         ob, reward, done, _ = env.step(action)
 
@@ -92,7 +88,8 @@ es = EvolutionModule(
     mother_parameters, partial_func, population_size=100,
     sigma=0.01, learning_rate=0.001, decay=0.9999,
     reward_goal=600, consecutive_goal_stopping=10, threadcount=1,
-    cuda=cuda, render_test=True, save_path=os.path.abspath(args.weights_path)
+    cuda=cuda, render_test=True, save_path=os.path.abspath(args.weights_path),
+    reward_factory=partial(make_reward_function, get_reward, partial(copy.deepcopy, model))
 )
 
 start = time.time()
@@ -101,4 +98,4 @@ end = time.time() - start
 
 pickle.dump(final_weights, open(os.path.abspath(args.weights_path), 'wb'))
 
-reward = partial_func(final_weights, render=True)
+reward = partial_func(parameters_to_vector(final_weights), render=True)
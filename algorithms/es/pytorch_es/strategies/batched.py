@@ -0,0 +1,73 @@
+"""
+Batched fitness evaluation: K candidates play in lockstep and share every forward pass
+"""
+import torch
+from torch.func import functional_call, vmap
+
+
+class BatchedEvaluator:
+    """
+    Reward function of a batch of candidates (a K x num_params tensor of flat parameter vectors).
+    Each candidate plays one episode on its own env; at every step the observations of the
+    running episodes go through all their perturbed policies in a single vmapped call,
+    and finished episodes drop out of the batch.
+    Envs follow the ES wrapper interface: reset() -> obs, step(action) -> (obs, reward, done).
+    Episodes still running after max_steps steps are cut off.
+    """
+
+    def __init__(self, model, env_factory, batch_size, act=None, max_steps=None):
+        self.model = model
+        self.max_steps = max_steps
+        self.envs = [env_factory() for _ in range(batch_size)]
+        self.act = act if act is not None else (lambda output: output.argmax(1))  # greedy by default
+        self.names = [name for name, _ in model.named_parameters()]
+        self.shapes = [param.size() for _, param in model.named_parameters()]
+        self.buffers = dict(model.named_buffers())
+        self.forward = vmap(self._forward)
+
+    def _forward(self, params, obs):
+        # one candidate on one observation, vmap adds the candidate dimension
+        return functional_call(self.model, ({**params, **self.buffers},), (obs.unsqueeze(0),)).squeeze(0)
+
+    def unflatten(self, candidates):
+        # name -> K x shape views into the candidates, without copying them
+        params, offset = {}, 0
+        for name, shape in zip(self.names, self.shapes):
+            size = shape.numel()
+            params[name] = candidates[:, offset:offset + size].view(len(candidates), *shape)
+            offset += size
+        return params
+
+    def __call__(self, candidates, render=False):
+        assert len(candidates) <= len(self.envs), "More candidates than envs"
+        envs = self.envs[:len(candidates)]
+        rewards = [0.] * len(candidates)
+        obs = [env.reset() for env in envs]
+        running = list(range(len(candidates)))
+        params = self.unflatten(candidates)
+        step = 0
+
+        while running and (self.max_steps is None or step < self.max_steps):
+            with torch.no_grad():
+                actions = self.act(self.forward(params, torch.stack([obs[i] for i in running]))).tolist()
+
+            finished = False
+            for i, action in zip(running, actions):
+                if render and i == 0:
+                    envs[i].render()
+                obs[i], reward, done = envs[i].step(action)
+                rewards[i] += reward
+                if done:
+                    obs[i] = None
+                    finished = True
+            step += 1
+
+            if finished:
+                # the parameters are only gathered again when the batch shrinks
+                running = [i for i in running if obs[i] is not None]
+                params = self.unflatten(candidates[running])
+
+        return rewards
+
+    def close(self):
+        [env.close() for env in self.envs]
@@ -0,0 +1,78 @@
+"""
+Multi-node evolution: nodes only exchange population seeds and (offset, fitness) pairs
+"""
+import math
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class DistributedEvolution:
+    """
+    Runs an EvolutionModule on every node of an initialized torch.distributed (gloo) group.
+    Each generation the coordinator broadcasts the parameter version and a population seed,
+    every node draws the same population from the shared noise table, evaluates its share
+    of the candidates on its local pool and all-gathers (offset, fitness) pairs.
+    All nodes then apply the identical update to their copy of the parameters.
+    With sync_interval > 0, the coordinator parameters are broadcast every sync_interval
+    generations to wipe out floating point drift between heterogeneous nodes.
+    """
+
+    def __init__(self, es, coordinator=0, sync_interval=0):
+        assert not es.theta.is_cuda, "Nodes exchange CPU parameters"
+        assert not es.importance_mixing, "Importance mixing is local to a node"
+        self.es = es
+        self.coordinator = coordinator
+        self.sync_interval = sync_interval
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.version = 0  # number of updates applied to the parameters
+        dist.broadcast(self.es.theta, self.coordinator)  # every node starts from the coordinator parameters
+
+    def is_coordinator(self):
+        return self.rank == self.coordinator
+
+    def gather_rewards(self, population, local_rewards):
+        # local candidates are population[rank::world_size], NaN marks the ones that did not complete
+        pairs = torch.full((math.ceil(len(population) / self.world_size), 2), float('nan'), dtype=torch.float64)
+        for row, (offset, _), reward in zip(pairs, population[self.rank::self.world_size], local_rewards):
+            row[0] = offset
+            row[1] = reward if reward is not None else float('nan')
+        gathered = [torch.empty_like(pairs) for _ in range(self.world_size)]
+        dist.all_gather(gathered, pairs)
+
+        rewards = [None] * len(population)
+        for rank, rank_pairs in enumerate(gathered):
+            for i, (offset, reward) in zip(range(rank, len(population), self.world_size), rank_pairs.tolist()):
+                assert int(offset) == population[i][0], "Nodes drew different populations"
+                rewards[i] = None if math.isnan(reward) else reward
+        return rewards
+
+    def run(self, iterations, print_step=10):
+        if self.is_coordinator():
+            print("Evolving %d generations on %d nodes." % (iterations, self.world_size))
+        for iteration in range(iterations):
+            header = torch.tensor([self.version, np.random.randint(2 ** 31)], dtype=torch.int64)
+            dist.broadcast(header, self.coordinator)
+            version, seed = header.tolist()
+            assert version == self.version, "Node at version %d, coordinator at %d" % (self.version, version)
+            if self.is_coordinator():
+                print('Generation: %d' % iteration)
+
+            population = self.es.sample_population(np.random.RandomState(seed))
+            local_rewards = self.es.evaluate(population[self.rank::self.world_size])
+            self.es.update(population, self.gather_rewards(population, local_rewards))
+            self.version += 1
+
+            if self.sync_interval and self.version % self.sync_interval == 0:
+                dist.broadcast(self.es.theta, self.coordinator)
+
+            if (iteration+1) % print_step == 0:
+                # only the coordinator tests and saves, its goal check stops every node
+                stop = torch.tensor([self.is_coordinator() and self.es.test(iteration+1)], dtype=torch.int64)
+                dist.broadcast(stop, self.coordinator)
+                if stop.item():
+                    break
+
+        return self.es.get_weights()
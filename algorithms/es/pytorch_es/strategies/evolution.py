@@ -1,13 +1,84 @@
 """
 Evolutionary Strategies module for PyTorch models -- modified from https://github.com/alirezamika/evostra
 """
-import copy
 from multiprocessing.pool import ThreadPool
+import logging
 import pickle
+import threading
 import time
 
 import numpy as np
 import torch
+import torch.multiprocessing as mp
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+
+from .noise import SharedNoiseTable
+
+# evolve() reports through logging, so callers driving it (like the ES agent) control its output;
+# run() and test() print, as the standalone scripts expect
+logger = logging.getLogger(__name__)
+
+
+def noise_vector(noise_table, offset, size, cuda=False):
+    # the noise of a candidate is the slice of the table starting at offset
+    noise = noise_table.get(offset, size)
+    return noise.cuda() if cuda else noise
+
+
+def centered_ranks(rewards):
+    # rank-based fitness shaping: ranks scaled to [-0.5, 0.5], insensitive to the reward scale and outliers
+    ranks = np.empty(len(rewards), dtype=np.float32)
+    ranks[np.argsort(rewards)] = np.arange(len(rewards))
+    return ranks / (len(rewards) - 1) - 0.5
+
+
+# State of an evaluation worker (thread or process), set once by _init_worker
+_worker = threading.local()
+
+
+def _init_worker(reward_factory, theta, noise_table, generation, single_thread, batch_size=1):
+    if single_thread:
+        torch.set_num_threads(1)  # parallelism comes from the processes
+    _worker.reward_function = reward_factory()  # every worker owns its env and model
+    _worker.theta = theta  # updated in place by the module (in shared memory for processes)
+    # perturbed in place for every evaluation
+    _worker.candidates = torch.empty(batch_size, len(theta), dtype=theta.dtype, device=theta.device)
+    _worker.noise_table = noise_table
+    _worker.generation = generation  # generation being evaluated, set by the module
+
+
+def current_generation():
+    # generation of the candidates being evaluated, for reward functions built by a reward_factory
+    return _worker.task_generation
+
+
+def _perturb(candidate, task):
+    offset, sign, sigma = task
+    candidate.copy_(_worker.theta)
+    return candidate.add_(noise_vector(_worker.noise_table, offset, len(candidate), candidate.is_cuda), alpha=sign * sigma)
+
+
+def _evaluate(task):
+    return _worker.reward_function(_perturb(_worker.candidates[0], task))
+
+
+def _evaluate_batch(tasks):
+    # the reward function gets the K x num_params candidates at once (see BatchedEvaluator)
+    candidates = _worker.candidates[:len(tasks)]
+    for candidate, task in zip(candidates, tasks):
+        _perturb(candidate, task)
+    return list(_worker.reward_function(candidates))
+
+
+def _evaluate_indexed(item):
+    # (index, generation, tasks) -> (index, rewards), tasks left over by a finished generation are skipped
+    index, generation, tasks = item
+    if _worker.generation.value != generation:
+        return index, None
+    _worker.task_generation = generation
+    if len(_worker.candidates) > 1:
+        return index, _evaluate_batch(tasks)
+    return index, [_evaluate(task) for task in tasks]
 
 
 class EvolutionModule:
@@ -26,18 +97,82 @@ class EvolutionModule:
         cuda=False,
         reward_goal=None,
         consecutive_goal_stopping=None,
-        save_path=None
+        save_path=None,
+        noise_table=None,
+        reward_factory=None,
+        processes=False,
+        fitness_shaping='normalize',
+        optimizer='sgd',
+        chunk_size=2 ** 16,
+        antithetic=False,
+        batch_size=1,
+        quorum=1.0,
+        deadline=None,
+        importance_mixing=False,
+        refresh_rate=0.1,
+        archive_generations=5
     ):
         np.random.seed(int(time.time()))
         self.weights = weights
+        # all parameters live in a single contiguous float32 vector, the weights being views into it,
+        # so reward functions receive a flat vector they can bind to their model with vector_to_parameters
+        self.theta = parameters_to_vector(weights).detach().float()
+        vector_to_parameters(self.theta, self.weights)
+        self.num_params = len(self.theta)
+        # candidates are (offset, sign) pairs indexing this table instead of freshly drawn noise
+        self.noise_table = noise_table if noise_table is not None else SharedNoiseTable()
+        assert len(self.noise_table) >= self.num_params, "Noise table is smaller than the number of parameters"
         self.reward_function = reward_func
         self.POPULATION_SIZE = population_size
+        # mirrored sampling: every noise draw is evaluated as +eps and -eps
+        assert not antithetic or population_size % 2 == 0, "Antithetic sampling needs an even population size"
+        self.antithetic = antithetic
         self.SIGMA = sigma
         self.LEARNING_RATE = learning_rate
         self.cuda = cuda
         self.decay = decay
         self.sigma_decay = sigma_decay
-        self.pool = ThreadPool(threadcount)
+        assert fitness_shaping in ('normalize', 'rank'), "Unknown fitness shaping '%s'" % fitness_shaping
+        self.fitness_shaping = fitness_shaping
+        # the gradient estimate is gathered chunk_size parameters at a time to bound the memory used
+        self.chunk_size = chunk_size
+        assert optimizer in ('sgd', 'adam'), "Unknown optimizer '%s'" % optimizer
+        self.optimizer = torch.optim.Adam([self.theta], lr=learning_rate) if optimizer == 'adam' else None
+        # with a reward_factory, every worker builds a reward function with its own env and model once,
+        # then only receives (offset, sign, sigma) and sends back the fitness
+        self.reward_factory = reward_factory
+        # with batch_size > 1, the reward functions built by reward_factory evaluate batch_size candidates per call
+        assert batch_size == 1 or reward_factory is not None, "Batched evaluation needs a reward_factory"
+        self.batch_size = batch_size
+        # a generation ends once a quorum fraction of the candidates reported or after deadline seconds,
+        # the update then only uses the completed candidates. These are the fastest ones: when the episode
+        # length depends on the policy they are biased towards early deaths (or early wins), so the cut
+        # biases the update. Antithetic pairs are dropped together, which only cancels part of it.
+        assert (quorum == 1.0 and deadline is None) or reward_factory is not None, "Partial generations need a reward_factory"
+        self.quorum = quorum
+        self.deadline = deadline
+        self.generation = mp.RawValue('i', 0)
+        # importance mixing reuses the evaluated candidates of the previous population that are still likely
+        # under the current distribution, at least refresh_rate of the population being fresh samples
+        assert not (importance_mixing and antithetic), "Importance mixing needs independent samples"
+        self.importance_mixing = importance_mixing
+        self.refresh_rate = refresh_rate
+        self.archive_generations = archive_generations
+        self.archive = []  # (offset, sign, reward, update) of the last population
+        self.centers = {}  # update -> (theta, sigma) the archived candidates were sampled around
+        self.updates = 0
+        if reward_factory is None:
+            self.pool = ThreadPool(threadcount)
+        elif not processes:
+            self.pool = ThreadPool(
+                threadcount, initializer=_init_worker, initargs=(reward_factory, self.theta, self.noise_table, self.generation, False, batch_size)
+            )
+        else:
+            assert not cuda, "The process backend evaluates on CPU"
+            self.theta.share_memory_()
+            self.pool = mp.get_context('fork').Pool(
+                threadcount, initializer=_init_worker, initargs=(reward_factory, self.theta, self.noise_table, self.generation, True, batch_size)
+            )
         self.pool.daemon = True
         self.render_test = render_test
         self.reward_goal = reward_goal
@@ -46,62 +181,209 @@ class EvolutionModule:
         self.save_path = save_path
 
 
-    def jitter_weights(self, weights, population=[], no_jitter=False):
-        new_weights = []
-        for i, param in enumerate(weights):
-            if no_jitter:
-                new_weights.append(param.data)
+    def jitter_weights(self, candidate=None, no_jitter=False):
+        if no_jitter:
+            return self.theta
+        noise = noise_vector(self.noise_table, candidate[0], self.num_params, self.theta.is_cuda)
+        return torch.add(self.theta, noise, alpha=candidate[1] * self.SIGMA)
+
+
+    def get_weights(self):
+        # copies owning their storage, views of theta would each pickle the whole vector
+        return [param.data.clone() for param in self.weights]
+
+
+    def close(self):
+        # joins the workers before interpreter shutdown tears their threads down
+        self.pool.close()
+        self.pool.join()
+
+
+    def collect(self, tasks):
+        # rewards in task order, None for the candidates that missed the quorum or the deadline
+        # (the slowest ones, see the quorum caveat in __init__)
+        rewards = [None] * len(tasks)
+        generation = self.generation.value
+        batches = [(i, generation, tasks[i:i + self.batch_size]) for i in range(0, len(tasks), self.batch_size)]
+        results = self.pool.imap_unordered(_evaluate_indexed, batches)
+        required = int(np.ceil(self.quorum * len(tasks)))
+        end = time.time() + self.deadline if self.deadline is not None else None
+        received = 0
+        try:
+            while received < required:
+                index, batch_rewards = results.next(None if end is None else max(end - time.time(), 0))
+                rewards[index:index + len(batch_rewards)] = batch_rewards
+                received += len(batch_rewards)
+        except mp.TimeoutError:
+            pass
+        self.generation.value += 1  # the workers skip the tasks still queued
+        return rewards
+
+
+    def step(self, gradient):
+        # gradient ascent on the flat vector
+        if self.optimizer is None:
+            self.theta.add_(gradient, alpha=self.LEARNING_RATE)
+            return
+        for group in self.optimizer.param_groups:
+            group['lr'] = self.LEARNING_RATE
+        self.theta.grad = gradient.neg_()  # the optimizer minimizes
+        self.optimizer.step()
+        self.theta.grad = None
+
+
+    def sample_population(self, rng=np.random):
+        # (offset, sign) pairs, drawn from rng so that nodes sharing its seed draw the same population
+        if self.antithetic:
+            return [
+                (offset, sign)
+                for offset in [self.noise_table.sample_offset(self.num_params, rng) for _ in range(self.POPULATION_SIZE // 2)]
+                for sign in (1, -1)
+            ]
+        return [(self.noise_table.sample_offset(self.num_params, rng), 1) for _ in range(self.POPULATION_SIZE)]
+
+
+    def evaluate(self, population):
+        # rewards in population order, None for the candidates that did not complete
+        if self.reward_factory is not None:
+            return self.collect([(offset, sign, self.SIGMA) for offset, sign in population])
+        return self.pool.map(
+            self.reward_function, 
+            [self.jitter_weights(candidate=candidate) for candidate in population]
+        )
+
+
+    def center(self, update):
+        return (self.theta, self.SIGMA) if update == self.updates else self.centers[update]
+
+
+    def log_density(self, entry, theta, sigma):
+        # log N(x; theta, sigma^2 I) up to a constant, for x = theta_u + sigma_u * sign * noise
+        offset, sign, _, update = entry
+        center, center_sigma = self.center(update)
+        noise = noise_vector(self.noise_table, offset, self.num_params, self.theta.is_cuda)
+        shift = center - theta
+        sq_distance = shift.dot(shift) + 2 * center_sigma * sign * shift.dot(noise) + center_sigma ** 2 * noise.dot(noise)
+        return -sq_distance.item() / (2 * sigma ** 2) - self.num_params * np.log(sigma)
+
+
+    def importance_mix(self):
+        """
+        Importance mixing (Sun et al., 2009). Archived candidates are kept with probability
+        min(1, (1 - refresh_rate) * p_new / p_old) and fresh candidates accepted with probability
+        max(refresh_rate, 1 - p_old / p_new), so the mixed population follows the current
+        distribution and its candidates keep unit weights.
+        Returns the reused archive entries and the fresh (offset, sign) candidates to evaluate.
+        """
+        if not self.archive:
+            return [], self.sample_population()
+
+        old_theta, old_sigma = self.centers[self.updates - 1]
+        reused = []
+        for entry in self.archive:
+            log_ratio = self.log_density(entry, self.theta, self.SIGMA) - self.log_density(entry, old_theta, old_sigma)
+            if np.random.rand() < np.exp(min(0, np.log(1 - self.refresh_rate) + log_ratio)):
+                reused.append(entry)
+        reused = reused[:self.POPULATION_SIZE]
+
+        population = []
+        while len(reused) + len(population) < self.POPULATION_SIZE:
+            entry = (self.noise_table.sample_offset(self.num_params), 1, None, self.updates)
+            log_ratio = self.log_density(entry, old_theta, old_sigma) - self.log_density(entry, self.theta, self.SIGMA)
+            if np.random.rand() < max(self.refresh_rate, 1 - np.exp(min(0, log_ratio))):
+                population.append(entry[:2])
+        return reused, population
+
+
+    def update(self, population, rewards, reused=()):
+        completed = [i for i, reward in enumerate(rewards) if reward is not None]
+        if self.antithetic:  # a pair is only usable when both of its candidates reported
+            completed = [i for i in completed if rewards[i ^ 1] is not None]
+        if len(completed) < len(population):
+            logger.info('%d/%d candidates completed', len(completed), len(population))
+        population = [population[i] for i in completed]
+        rewards = [rewards[i] for i in completed]
+        # (offset, sign, reward, update): reused candidates were sampled around the parameters of an earlier update
+        entries = [(offset, sign, reward, self.updates) for (offset, sign), reward in zip(population, rewards)]
+        entries += list(reused)
+        rewards = [reward for _, _, reward, _ in entries]
+        if self.importance_mixing:
+            self.centers[self.updates] = (self.theta.clone(), self.SIGMA)
+
+        if len(rewards) > 1 and np.std(rewards) != 0:
+            if self.fitness_shaping == 'rank':
+                shaped_rewards = centered_ranks(rewards)
+            else:
+                shaped_rewards = (rewards - np.mean(rewards)) / np.std(rewards)
+            # sum of reward * (candidate - theta) / sigma over the population, rebuilt from the table
+            if self.antithetic:
+                # a pair shares its noise, so only half of it is gathered, weighted by the paired difference
+                offsets = [offset for offset, _ in population[::2]]
+                noise_weights = shaped_rewards[0::2] - shaped_rewards[1::2]
+            else:
+                offsets = [offset for offset, _, _, _ in entries]
+                noise_weights = shaped_rewards * [sign * self.center(update)[1] / self.SIGMA for _, sign, _, update in entries]
+            gradient = self.noise_table.weighted_sum(
+                offsets, noise_weights, self.num_params, self.chunk_size
+            ).to(self.theta.device)
+            for update in set(update for _, _, _, update in entries) - {self.updates}:
+                # reused candidates are also shifted by the distance between their center and theta
+                coefficient = sum(w for w, (_, _, _, u) in zip(shaped_rewards, entries) if u == update)
+                gradient.add_(self.centers[update][0] - self.theta, alpha=float(coefficient) / self.SIGMA)
+            gradient.div_(len(entries) * self.SIGMA)
+            self.step(gradient)  # in place, shared with the workers
+
+            self.LEARNING_RATE *= self.decay
+            self.SIGMA *= self.sigma_decay
+
+        if self.importance_mixing:
+            # the archive is bounded to the candidates of the last archive_generations updates
+            oldest = self.updates - self.archive_generations + 1
+            self.archive = [entry for entry in entries if entry[3] >= oldest]
+            self.centers = {update: center for update, center in self.centers.items() if update >= oldest}
+        self.updates += 1
+
+
+    def test(self, iteration):
+        # evaluates and saves the current weights, returns True once the reward goal is reached
+        test_reward = self.reward_function(self.jitter_weights(no_jitter=True), render=self.render_test)
+        print('Generation: %d | Reward: %f' % (iteration, test_reward))
+
+        if self.save_path:
+            pickle.dump(self.get_weights(), open(self.save_path, 'wb'))
+        
+        if self.reward_goal and self.consecutive_goal_stopping:
+            if test_reward >= self.reward_goal:
+                self.consecutive_goal_count += 1
             else:
-                jittered = torch.from_numpy(self.SIGMA * population[i]).float()
-                if self.cuda:
-                    jittered = jittered.cuda()
-                new_weights.append(param.data + jittered)
-        return new_weights
+                self.consecutive_goal_count = 0
+
+            if self.consecutive_goal_count >= self.consecutive_goal_stopping:
+                return True
+        return False
+
+
+    def evolve(self):
+        # one generation, returns the rewards of the candidates the update used
+        reused = []
+        if self.importance_mixing:
+            reused, population = self.importance_mix()
+            if reused:
+                logger.info('Reusing %d archived candidates', len(reused))
+        else:
+            population = self.sample_population()
+        rewards = self.evaluate(population)
+        self.update(population, rewards, reused)
+        return [reward for reward in rewards if reward is not None] + [reward for _, _, reward, _ in reused]
 
 
     def run(self, iterations, print_step=10):
         print("Evolving %d generations." % iterations)
         for iteration in range(iterations):
             print('Generation: %d' % iteration)
-            population = []
-            for _ in range(self.POPULATION_SIZE):
-                x = []
-                for param in self.weights:
-                    x.append(np.random.randn(*param.data.size()))
-                population.append(x)
-
-            rewards = self.pool.map(
-                self.reward_function, 
-                [self.jitter_weights(copy.deepcopy(self.weights), population=pop) for pop in population]
-            )
-            if np.std(rewards) != 0:
-                normalized_rewards = (rewards - np.mean(rewards)) / np.std(rewards)
-                for index, param in enumerate(self.weights):
-                    A = np.array([p[index] for p in population])
-                    rewards_pop = torch.from_numpy(np.dot(A.T, normalized_rewards).T).float()
-                    if self.cuda:
-                        rewards_pop = rewards_pop.cuda()
-                    param.data = param.data + self.LEARNING_RATE / (self.POPULATION_SIZE * self.SIGMA) * rewards_pop
-
-                    self.LEARNING_RATE *= self.decay
-                    self.SIGMA *= self.sigma_decay
-
-            if (iteration+1) % print_step == 0:
-                test_reward = self.reward_function(
-                    self.jitter_weights(copy.deepcopy(self.weights), no_jitter=True), render=self.render_test
-                )
-                print('Generation: %d | Reward: %f' % (iteration+1, test_reward))
-
-                if self.save_path:
-                    pickle.dump(self.weights, open(self.save_path, 'wb'))
-                
-                if self.reward_goal and self.consecutive_goal_stopping:
-                    if test_reward >= self.reward_goal:
-                        self.consecutive_goal_count += 1
-                    else:
-                        self.consecutive_goal_count = 0
-
-                    if self.consecutive_goal_count >= self.consecutive_goal_stopping:
-                        return self.weights
-
-        return self.weights
\ No newline at end of file
+            self.evolve()
+
+            if (iteration+1) % print_step == 0 and self.test(iteration+1):
+                return self.get_weights()
+
+        return self.get_weights()
@@ -0,0 +1,43 @@
+"""
+Shared noise table for seed-indexed perturbations
+"""
+import numpy as np
+import torch
+
+
+class SharedNoiseTable:
+    """
+    Large table of float32 N(0, 1) noise, generated once from a fixed seed and kept in shared memory.
+    A perturbation of n parameters is the slice noise[offset:offset + n], so a candidate
+    only needs its offset to be described and every process (or node) can rebuild it.
+    """
+
+    def __init__(self, size=int(25e6), seed=123):
+        self.seed = seed
+        self.noise = torch.from_numpy(
+            np.random.default_rng(seed).standard_normal(size, dtype=np.float32)
+        ).share_memory_()
+
+    def __len__(self):
+        return len(self.noise)
+
+    def get(self, offset, size):
+        return self.noise[offset:offset + size]
+
+    def sample_offset(self, size, rng=np.random):
+        return rng.randint(0, len(self.noise) - size + 1)
+
+    def weighted_sum(self, offsets, weights, size, chunk_size=2 ** 16):
+        """
+        sum_i weights[i] * noise[offsets[i]:offsets[i] + size] as one float32 matrix product per chunk
+        of parameters, so at most len(offsets) x chunk_size noise values are gathered at a time.
+        """
+        weights = torch.as_tensor(weights, dtype=torch.float32)
+        result = torch.empty(size, dtype=torch.float32)
+        noise = torch.empty(len(offsets), min(chunk_size, size), dtype=torch.float32)  # reused by every chunk
+        for start in range(0, size, chunk_size):
+            end = min(start + chunk_size, size)
+            for row, offset in zip(noise, offsets):
+                row[:end - start].copy_(self.noise[offset + start:offset + end])
+            torch.mv(noise[:, :end - start].t(), weights, out=result[start:end])
+        return result
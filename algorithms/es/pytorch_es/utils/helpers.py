@@ -1,7 +1,48 @@
 """Helpers for PyTorch-ES examples"""
+from functools import partial
+
+from ..strategies.evolution import current_generation
 
 
 def weights_init(m):
     classname = m.__class__.__name__
     if classname.find('Linear') != -1:
         m.weight.data.normal_(0.0, 0.02)
+
+
+def make_reward_function(reward_function, model_factory, env_factory=None, **kwargs):
+    """
+    Binds reward_function(weights, model=..., env=..., **kwargs) to a model and an env of its own
+    (no env without env_factory). Pass partial(make_reward_function, ...) as the reward_factory of
+    EvolutionModule, so every evaluation worker builds them once and then only receives noise offsets.
+    With a list of env factories (levels), see GenerationEnv.
+    """
+    if isinstance(env_factory, list):
+        return GenerationEnv(reward_function, model_factory(), env_factory, **kwargs)
+    if env_factory is not None:
+        kwargs['env'] = env_factory()
+    return partial(reward_function, model=model_factory(), **kwargs)
+
+
+class GenerationEnv:
+    """
+    Reward function playing generation g on the level env_factories[g % len(env_factories)], so all the
+    candidates of a generation are ranked on the same level instead of on the level their worker owns.
+    A worker keeps one env, rebuilt when the level changes. The rewards of candidates reused by importance
+    mixing come from earlier levels.
+    """
+
+    def __init__(self, reward_function, model, env_factories, **kwargs):
+        self.reward_function = reward_function
+        self.model = model
+        self.env_factories = env_factories
+        self.kwargs = kwargs
+        self.level, self.env = None, None
+
+    def __call__(self, weights, **kwargs):
+        level = current_generation() % len(self.env_factories)
+        if level != self.level:
+            if self.env is not None:
+                self.env.close()
+            self.level, self.env = level, self.env_factories[level]()
+        return self.reward_function(weights, model=self.model, env=self.env, **self.kwargs, **kwargs)
@@ -1,6 +1,6 @@
+# Standalone ES trainer, run as a module from the repository root: python -m algorithms.es.train
 import argparse
 from collections import deque
-import copy
 from functools import partial
 import gc
 import logging
@@ -12,16 +12,18 @@ import sys
 import time
 
 # from evostra import EvolutionStrategy
-from pytorch_es import EvolutionModule
-from pytorch_es.utils.helpers import weights_init
+from .pytorch_es import EvolutionModule, BatchedEvaluator, DistributedEvolution
+from .pytorch_es.utils.helpers import weights_init, make_reward_function
 import numpy as np
 from PIL import Image
 import torch
+import torch.distributed as dist
 from torch.autograd import Variable
 import torch.nn as nn
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 import torchvision
 
-from agent import Agent
+from .agent import Agent
 
 parser = argparse.ArgumentParser(description='Evolution Strategies')
 parser.add_argument('-w', '--weights_path', type=str, default='results.pkl', help='Path to save final weights')
@@ -30,21 +32,35 @@ parser.add_argument('-g', '--generations', type=int, default=1000, help='Number
 parser.add_argument('-s', '--print_steps', type=int, default=10, help='Test and print agent every p steps.')
 parser.add_argument('-p', '--population', type=int, default=100, help='Population size.')
 parser.add_argument('--seed', type=int, default=123, help='Random seed for atari_py')
-parser.add_argument('--threads', type=int, default=1, help='Number of worker threads')
+parser.add_argument('--threads', type=int, default=1, help='Number of worker threads (or processes)')
+parser.add_argument('--processes', action='store_true', help='Evaluate candidates on processes owning their env and model')
 parser.add_argument('--wrapper', type=str, default='gvgai', help='Game emulator wrapper framework')
 parser.add_argument('--game', type=str, default='gvgai-cec1-lvl0-v0', help='Game identifier')  # default='space_invaders' gvgai-cec1-lvl0-v0
 parser.add_argument('--max-episode-length', type=int, default=int(108e3), metavar='LENGTH',
                     help='Max episode length (0 to disable)')
+parser.add_argument('--encoder', type=str, default='nature', help='Convolution body (nature/impala/separable)')
 parser.add_argument('--history-length', type=int, default=4, metavar='T', help='Number of consecutive states processed')
 parser.add_argument('--lr', type=float, default=0.0000625, metavar='η', help='Learning rate')
+parser.add_argument('--fitness-shaping', type=str, default='normalize', choices=['normalize', 'rank'], help='Reward normalization')
+parser.add_argument('--optimizer', type=str, default='sgd', choices=['sgd', 'adam'], help='Update rule of the parameters')
+parser.add_argument('--antithetic', action='store_true', help='Evaluate every noise draw as +eps and -eps')
+parser.add_argument('--batch-size', type=int, default=1, help='Candidates played in lockstep by every worker, sharing batched forwards')
+parser.add_argument('--quorum', type=float, default=1.0, help='Fraction of the candidates ending a generation. Below 1 the update favours the candidates with the shortest episodes')
+parser.add_argument('--deadline', type=float, default=None, help='Seconds after which a generation ends with the candidates done so far (biased like --quorum)')
+parser.add_argument('--step-budget', type=int, default=0, help='Max steps of an evaluation episode (0 to use --max-episode-length)')
+parser.add_argument('--importance-mixing', action='store_true', help='Reuse the evaluations still likely under the updated distribution')
+parser.add_argument('--world-size', type=int, default=1, help='Number of nodes sharing the evolution')
+parser.add_argument('--rank', type=int, default=0, help='Rank of this node (0 coordinates)')
+parser.add_argument('--master-addr', type=str, default='127.0.0.1', help='Address of the coordinator node')
+parser.add_argument('--master-port', type=int, default=29500, help='Port of the coordinator node')
 parser.add_argument('--evaluate', action='store_true', help='Evaluate only')
 parser.add_argument('--render', action='store_true', help='Render on test')
 args = parser.parse_args()
 
 if args.wrapper == 'gvgai':
-    from env_gvgai import Env
+    from .env_gvgai import Env
 elif args.wrapper == 'gym':
-    from env_gym import Env
+    from .env_gym import Env
     if args.game == 'gvgai-cec1-lvl0-v0':
         args.game = 'SpaceInvaders-v0'
 else:
@@ -69,20 +85,15 @@ else:
 
 num_features = 16
 
-model = (Agent(args)).model
 env = Env(args)
-max_episode_length = args.max_episode_length
+model = (Agent(args, env)).model
+max_episode_length = args.step_budget or args.max_episode_length  # cuts off runaway candidates
 
-def get_reward(weights, model, render=False):
-    global env
+def get_reward(weights, model, env, render=False):
     global max_episode_length
 
-    cloned_model = copy.deepcopy(model)
-    for i, param in enumerate(cloned_model.parameters()):
-        try:
-            param.data = weights[i]
-        except:
-            param.data = weights[i].data
+    # weights is a flat parameter vector, the model parameters become views into it (no copy)
+    vector_to_parameters(weights, model.parameters())
 
     obs = env.reset()
     done = False
@@ -92,35 +103,65 @@ def get_reward(weights, model, render=False):
         if render:
             env.render()
         with torch.no_grad():
-            prediction = cloned_model(obs.unsqueeze(0))
+            prediction = model(obs.unsqueeze(0))
             action = prediction.data.max(1)[1].item()
         obs, reward, done = env.step(action)
 
         total_reward += reward 
         i += 1
-    env.close()
     return total_reward
 
 
-partial_func = partial(get_reward, model=model)
+def make_model():
+    # the action count is read from the env of this process, every evaluation process builds its own model
+    return (Agent(args, env)).model
+
+
+def make_batched_evaluator():
+    # called once on every evaluation process, each one plays batch_size envs in lockstep with its own model
+    return BatchedEvaluator(make_model(), partial(Env, args), args.batch_size, max_steps=max_episode_length)
+
+
+partial_func = partial(get_reward, model=model, env=env)
 mother_parameters = list(model.parameters())
 
 es = EvolutionModule(
     mother_parameters, partial_func, population_size=args.population,
     sigma=0.01, learning_rate=args.lr, decay=0.9999,
     reward_goal=600, consecutive_goal_stopping=10, threadcount=args.threads,
-    cuda=(args.device == torch.device('cuda')), render_test=args.render, save_path=os.path.abspath(args.weights_path)
+    cuda=(args.device == torch.device('cuda')), render_test=args.render,
+    save_path=os.path.abspath(args.weights_path) if args.rank == 0 else None,
+    reward_factory=make_batched_evaluator if args.batch_size > 1 else partial(make_reward_function, get_reward, make_model, partial(Env, args)),
+    processes=args.processes,
+    fitness_shaping=args.fitness_shaping, optimizer=args.optimizer, antithetic=args.antithetic,
+    batch_size=args.batch_size, quorum=args.quorum, deadline=args.deadline,
+    importance_mixing=args.importance_mixing
 )
 
 start = time.time()
-final_weights = es.run(args.generations, print_step=args.print_steps)
+if args.world_size > 1:
+    # nodes only exchange population seeds and fitnesses, each one applies the same update
+    dist.init_process_group(
+        'gloo', init_method='tcp://%s:%d' % (args.master_addr, args.master_port),
+        rank=args.rank, world_size=args.world_size
+    )
+    final_weights = DistributedEvolution(es).run(args.generations, print_step=args.print_steps)
+    dist.destroy_process_group()
+else:
+    final_weights = es.run(args.generations, print_step=args.print_steps)
 end = time.time() - start
+es.close()
+
+if args.rank != 0:
+    env.close()
+    exit()
 
 pickle.dump(final_weights, open(os.path.abspath(args.weights_path), 'wb'))
 print("Saved final weights to " + args.weights_path)
 
 
-reward = partial_func(final_weights, render=True)
+reward = partial_func(parameters_to_vector(final_weights), render=True)
 
 print("Reward from final weights: " + str(reward))
 print("Time to completion: " + str(end))
+env.close()
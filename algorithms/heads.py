@@ -0,0 +1,99 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def convert_heads(named, fused, hidden_size=512):
+    """
+    Converts entries keyed by parameter name (state dict or per parameter optimizer state)
+    between the two-head layout and the fused head layout of ActorCriticHeads. Both layouts compute the same function.
+    """
+
+    def cat(a, b):
+        return torch.cat([a, b]) if torch.is_tensor(a) and a.dim() > 0 else a
+
+    def split(a, i):
+        return a[i * hidden_size:(i + 1) * hidden_size] if torch.is_tensor(a) and a.dim() > 0 else a
+
+    converted = {k: v for k, v in named.items() if not k.startswith(('policy', 'value', 'hidden'))}
+    for p in ['weight', 'bias']:
+        if fused:
+            converted['hidden.' + p] = cat(named['policy.0.' + p], named['value.0.' + p])
+            converted['policy_out.' + p] = named['policy.2.' + p]
+            converted['value_out.' + p] = named['value.2.' + p]
+        else:
+            converted['policy.0.' + p] = split(named['hidden.' + p], 0)
+            converted['value.0.' + p] = split(named['hidden.' + p], 1)
+            converted['policy.2.' + p] = named['policy_out.' + p]
+            converted['value.2.' + p] = named['value_out.' + p]
+    return converted
+
+
+class ActorCriticHeads(nn.Module):
+    """
+    Base of the conv actor-critic models: a policy head and a value head on the features of the body,
+    either as two Sequentials or fused, a single GEMM computing the hidden layers of both heads.
+    Both layouts compute the same function and checkpoints of the other layout are converted when loaded.
+    """
+
+    def build_heads(self, in_features, n_actions, fused_heads=False, hidden_size=512):
+        self.fused_heads = fused_heads
+        self.hidden_size = hidden_size
+
+        if fused_heads:
+            # policy rows first, then value rows
+            self.hidden = nn.Linear(in_features, 2 * hidden_size)
+            self.policy_out = nn.Linear(hidden_size, n_actions)
+            self.value_out = nn.Linear(hidden_size, 1)
+        else:
+            # First head is returning the policy with probability distribution over actions
+            self.policy = nn.Sequential(
+                nn.Linear(in_features, hidden_size),
+                nn.ReLU(),
+                nn.Linear(hidden_size, n_actions)
+            )
+
+            # Second head returns one single number (approximate state's value)
+            self.value = nn.Sequential(
+                nn.Linear(in_features, hidden_size),
+                nn.ReLU(),
+                nn.Linear(hidden_size, 1)
+            )
+
+    def forward_heads(self, features):
+        # Returns a tuple of two tensors: policy logits and value
+        if self.fused_heads:
+            policy_hidden, value_hidden = F.relu(self.hidden(features)).split(self.hidden_size, dim=1)
+            return self.policy_out(policy_hidden), self.value_out(value_hidden)
+        return self.policy(features), self.value(features)
+
+    def forward_policy(self, features):
+        # Only the policy rows of the fused layer are multiplied
+        if self.fused_heads:
+            hidden = F.linear(features, self.hidden.weight[:self.hidden_size], self.hidden.bias[:self.hidden_size])
+            return self.policy_out(F.relu(hidden))
+        return self.policy(features)
+
+    def policy_head(self):
+        # Returns the policy head as a standalone Sequential (a copy of the policy rows for the fused layout)
+        if not self.fused_heads:
+            return self.policy
+
+        hidden = nn.Linear(self.hidden.in_features, self.hidden_size)
+        with torch.no_grad():
+            hidden.weight.copy_(self.hidden.weight[:self.hidden_size])
+            hidden.bias.copy_(self.hidden.bias[:self.hidden_size])
+        return nn.Sequential(hidden, nn.ReLU(), self.policy_out)
+
+    def policy_head_weights(self):
+        # (weight, bias) of the linear layers of the policy head, views into the fused layer for the fused layout
+        if not self.fused_heads:
+            return [(layer.weight, layer.bias) for layer in self.policy if isinstance(layer, nn.Linear)]
+        return [(self.hidden.weight[:self.hidden_size], self.hidden.bias[:self.hidden_size]),
+                (self.policy_out.weight, self.policy_out.bias)]
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # checkpoints of the other head layout are converted on the fly
+        if self.fused_heads != ('hidden.weight' in state_dict):
+            state_dict = convert_heads(state_dict, self.fused_heads, self.hidden_size)
+        return super(ActorCriticHeads, self).load_state_dict(state_dict, *args, **kwargs)
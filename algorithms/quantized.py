@@ -0,0 +1,128 @@
+import collections
+import copy
+import time
+import torch
+import torch.nn as nn
+import torch.ao.quantization as quantization
+
+from algorithms.encoders import conv_relu_pairs
+from utils import quantize_weight
+
+
+class QuantizedModel(nn.Module):
+    """
+    int8 copy of a network, only used for acting on CPU: a statically quantized copy of its encoder
+    (conv + relu fused, activation ranges calibrated on the states given to quantize()) followed by
+    dynamically quantized linear heads.
+    Subclasses build the float heads, call quantize() and implement forward with features().
+    """
+
+    def __init__(self, encoder, heads):
+        super(QuantizedModel, self).__init__()
+
+        self.quant = quantization.QuantStub()
+        self.conv = copy.deepcopy(encoder)
+        self.dequant = quantization.DeQuantStub()
+        self.heads = heads
+        self.eval()
+
+    def quantize(self, calibration_states):
+        # static int8 convolutions: fuse conv + relu, observe activations and convert
+        quantization.fuse_modules(self.conv, conv_relu_pairs(self.conv), inplace=True)
+        qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+        self.conv_weight_observer = qconfig.weight
+        self.qconfig = qconfig
+        self.heads.qconfig = None
+        quantization.prepare(self, inplace=True)
+        with torch.no_grad():
+            self.forward(calibration_states)
+        quantization.convert(self, inplace=True)
+
+        # dynamic int8 linear layers: activations are quantized on the fly
+        self.linear_weight_observer = quantization.default_dynamic_qconfig.weight
+        quantization.quantize_dynamic(self.heads, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    def features(self, x):
+        x = self.dequant(self.conv(self.quant(x)))
+        return x.reshape(x.size(0), -1)  # reshape also handles channels last outputs
+
+    def requantize(self, encoder, head_weights):
+        # head_weights are the (weight, bias) of the float heads, in the order of the linear layers in self.heads
+        with torch.no_grad():
+            # fused modules keep the names of the convolutions, so both encoders can be matched by name
+            float_layers = dict(encoder.named_modules())
+            for name, layer in self.conv.named_modules():
+                if hasattr(layer, 'set_weight_bias'):
+                    float_layer = float_layers[name]
+                    layer.set_weight_bias(quantize_weight(float_layer.weight, self.conv_weight_observer()), float_layer.bias.detach())
+            linear_layers = [layer for layer in self.heads.children() if hasattr(layer, 'set_weight_bias')]
+            for layer, (weight, bias) in zip(linear_layers, head_weights):
+                layer.set_weight_bias(quantize_weight(weight, self.linear_weight_observer()), bias.detach())
+
+
+class QuantizedCopy:
+    """
+    Keeps the int8 copy of a float model used for acting, built by build(model, calibration_states)
+    once calibration_size states were acted on. Requantizing costs far more than an int8 forward saves,
+    so refresh() only requantizes the weights every refresh_interval model updates, and every
+    recalibrate_interval requantizations the activation ranges are calibrated again on the last acted states.
+    """
+
+    def __init__(self, build, model, calibration_size=64, refresh_interval=10, recalibrate_interval=10):
+        self.build = build
+        self.model = model
+        self.net = None  # the int8 copy, None until calibrated
+        self.calibration_size = calibration_size
+        self.refresh_interval = refresh_interval
+        self.recalibrate_interval = recalibrate_interval
+        self.updates = 0  # model updates since the last requantization
+        self.refreshes = 0  # requantizations since the last calibration
+        self.states = collections.deque(maxlen=calibration_size)  # last acted states
+
+    def observe(self, states):
+        # records a batch of acted states (copied, callers may reuse their buffers)
+        self.states.extend(states.clone())
+        if self.net is None and len(self.states) == self.calibration_size:
+            self.net = self.build(self.model, torch.stack(list(self.states)))
+
+    def refresh(self, force=False):
+        # called after every update of the model, force requantizes right away
+        if self.net is None:
+            return
+        self.updates += 1
+        if not force and self.updates < self.refresh_interval:
+            return
+        self.updates = 0
+        self.refreshes += 1
+        if self.refreshes >= self.recalibrate_interval:
+            self.net = self.build(self.model, torch.stack(list(self.states)))
+            self.refreshes = 0
+        else:
+            self.net.refresh(self.model)
+
+
+def refresh_report(quantized, fp32_latency, int8_latency, steps_per_update):
+    """
+    Times the requantization and the recalibration of a calibrated QuantizedCopy. The break-even refresh interval
+    is the number of model updates (of steps_per_update acting steps each) the int8 copy must be kept between
+    requantizations for its faster forwards to pay for them.
+    """
+    start = time.perf_counter()
+    quantized.net.refresh(quantized.model)
+    refresh_latency = time.perf_counter() - start
+
+    start = time.perf_counter()
+    quantized.build(quantized.model, torch.stack(list(quantized.states)))
+    recalibrate_latency = time.perf_counter() - start
+
+    # requantization cost per refresh, with a recalibration every recalibrate_interval refreshes
+    refresh_cost = refresh_latency + recalibrate_latency / quantized.recalibrate_interval
+    update_saving = (fp32_latency - int8_latency) * steps_per_update
+
+    return {
+        "refresh_ms": refresh_latency * 1e3,
+        "recalibrate_ms": recalibrate_latency * 1e3,
+        "saving_per_update_ms": update_saving * 1e3,
+        # int8 acting is slower than fp32 below this refresh interval (inf if int8 forwards are not faster)
+        "break_even_refresh_interval": refresh_cost / update_saving if update_saving > 0 else float('inf')
+    }
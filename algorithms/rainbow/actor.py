@@ -0,0 +1,135 @@
+import copy
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from .agent import Agent
+from .memory import BlockBuilder
+
+
+# Copies the learner's online network into the shared one read by the actors
+def publish_weights(weights, net):
+    shared_net, lock, version = weights
+    with lock:
+        for shared, param in zip(shared_net.state_dict().values(), net.state_dict().values()):
+            shared.copy_(param)
+        version.value += 1
+
+
+class Actor(mp.Process):
+    """
+    Ape-X style actor: plays on its own env with a CPU copy of the online network, refreshed from the shared one
+    every sync_interval steps, and sends its transitions to the learner in blocks of a BlockBuilder, with initial
+    priorities given by the loss of the actor networks.
+    """
+
+    def __init__(self, actor_id, args, env_class, shared_net, weights_lock, weights_version, blocks, stop,
+                 block_size=100, sync_interval=400):
+        super(Actor, self).__init__()
+        self.actor_id = actor_id
+        self.args = args
+        self.env_class = env_class
+        self.shared_net = shared_net
+        self.weights_lock = weights_lock
+        self.weights_version = weights_version
+        self.blocks = blocks  # queue of blocks to the learner
+        self.stop = stop
+        self.block_size = block_size
+        self.sync_interval = sync_interval
+
+    def _refresh(self, dqn, version):
+        if self.weights_version.value == version:
+            return version
+        with self.weights_lock:
+            dqn.online_net.load_state_dict(self.shared_net.state_dict())
+            version = self.weights_version.value
+        dqn.update_target_net()
+        return version
+
+    # Initial priorities of the new transitions start to end of a block, the n-step targets stay within the block
+    def _priorities(self, dqn, states, transitions, start, end):
+        n, (_, _, actions, rewards, nonterminals) = self.args.multi_step, transitions
+        idxs = np.arange(start, end)
+        returns, alive = np.zeros(len(idxs), dtype=np.float32), np.ones(len(idxs), dtype=np.bool_)
+        for k in range(n):  # Truncated n-step returns, rewards after a terminal are not counted
+            returns += alive * self.args.discount ** k * rewards[idxs + k]
+            alive &= nonterminals[idxs + k]
+        return dqn.priorities(
+            torch.stack(states[start:end]),
+            torch.from_numpy(actions[start:end]),
+            torch.from_numpy(returns),
+            torch.stack(states[start + n:end + n]),
+            torch.from_numpy(alive.astype(np.float32)).unsqueeze(1))
+
+    def run(self):
+        torch.set_num_threads(1)  # Actors share the cores, one each
+        args = copy.copy(self.args)
+        args.device, args.model = torch.device('cpu'), None
+        args.seed = args.seed + self.actor_id
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+        env = self.env_class(args)
+        env.train()
+        dqn = Agent(args, env)
+        dqn.train()
+        version = self._refresh(dqn, -1)
+
+        builder = BlockBuilder(args.history_length, args.multi_step, self.block_size)
+        done, step = True, 0
+        while not self.stop.is_set():
+            if done:
+                state, done = env.reset(), False
+            if step % args.replay_frequency == 0:
+                dqn.reset_noise()  # Draw a new set of noisy weights
+            if step % self.sync_interval == 0:
+                version = self._refresh(dqn, version)
+
+            action = dqn.act(state)
+            next_state, reward, done = env.step(action)
+            if args.reward_clip > 0:
+                reward = max(min(reward, args.reward_clip), -args.reward_clip)  # Clip rewards
+            if builder.append(state, action, reward, done):
+                states, transitions, (start, end) = builder.pop()
+                self.blocks.put((transitions, self._priorities(dqn, states, transitions, start, end), start, end))
+            state = next_state
+            step += 1
+
+        env.close()
+        self.blocks.put(None)
+
+
+# Starts n_actors actors sharing a CPU copy of the learner network, returns them, their block queue, their stop event
+# and the shared weights to publish to
+def start_actors(n_actors, args, env_class, net, block_size=100, sync_interval=400):
+    shared_net = copy.deepcopy(net).cpu()
+    shared_net.share_memory()
+    weights_lock, weights_version = mp.Lock(), mp.Value('i', 0)
+    blocks, stop = mp.Queue(maxsize=4 * n_actors), mp.Event()  # Bounded so actors wait for a slow learner
+    actors = [Actor(i, args, env_class, shared_net, weights_lock, weights_version, blocks, stop,
+                    block_size=block_size, sync_interval=sync_interval) for i in range(n_actors)]
+    [a.start() for a in actors]
+    return actors, blocks, stop, (shared_net, weights_lock, weights_version)
+
+
+# Gets the blocks waiting in the queue, waiting for one if block is set
+def get_blocks(blocks, block=False):
+    received = []
+    try:
+        received.append(blocks.get(block=block))
+        while True:
+            received.append(blocks.get_nowait())
+    except queue.Empty:
+        pass
+    return received
+
+
+# Stops the actors, draining the queue until each of them said it finished
+def stop_actors(actors, blocks, stop):
+    stop.set()
+    finished = 0
+    while finished < len(actors):
+        if blocks.get() is None:
+            finished += 1
+    [a.join() for a in actors]
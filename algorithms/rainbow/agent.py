@@ -1,9 +1,12 @@
+import io
 import os
+import time
 import numpy as np
 import torch
 from torch import optim
 
-from model import DQN
+from ..quantized import QuantizedCopy, refresh_report
+from .model import DQN, QuantizedDQN
 
 
 class Agent():
@@ -32,26 +35,49 @@ class Agent():
 
         self.optimiser = optim.Adam(self.online_net.parameters(), lr=args.lr, eps=args.adam_eps)
 
+        # Optional int8 copy of the online net used for acting (CPU only), calibrated on the first acted states
+        # and requantized every quantize_refresh updates (noise resets or optimiser steps)
+        self.quantized = None
+        if args.quantize_act and args.device.type == 'cpu':
+            self.quantized = QuantizedCopy(QuantizedDQN, self.online_net, refresh_interval=args.quantize_refresh)
+
     # Resets noisy weights in all linear layers (of online net only)
     def reset_noise(self):
         self.online_net.reset_noise()
+        self._refresh_quantized()
+
+    # Counts an update of the online net for its int8 copy, force requantizes it right away
+    def _refresh_quantized(self, force=False):
+        if self.quantized is not None:
+            self.quantized.refresh(force)
+
+    # Returns the network used for acting, the int8 copy once it is calibrated
+    def _acting_net(self, states):
+        if self.quantized is None:
+            return self.online_net
+        self.quantized.observe(states)
+        return self.quantized.net or self.online_net
 
     # Acts based on single state (no batch)
     def act(self, state):
+        return self.act_batch(state.unsqueeze(0))[0]
+
+    # Acts on a batch of states (one per env) with a single forward pass, returns a list of actions
+    def act_batch(self, states):
         with torch.no_grad():
-            return (self.online_net(state.unsqueeze(0)) * self.support).sum(2).argmax(1).item()
+            return (self._acting_net(states)(states) * self.support).sum(2).argmax(1).tolist()
 
     # Acts with an ε-greedy policy (used for evaluation only)
     def act_e_greedy(self, state, epsilon=0.001):  # High ε can reduce evaluation scores drastically
         return np.random.randint(0, self.action_space) if np.random.random() < epsilon else self.act(state)
 
-    def learn(self, mem):
-        # Sample transitions
-        idxs, states, actions, returns, next_states, nonterminals, weights = mem.sample(self.batch_size)
+    # Cross-entropy between the projected n-step target distribution and the predicted one, per transition
+    def _loss(self, states, actions, returns, next_states, nonterminals):
+        batch_size = len(states)
 
         # Calculate current state probabilities (online network noise already sampled)
         log_ps = self.online_net(states, log=True)  # Log probabilities log p(s_t, ·; θonline)
-        log_ps_a = log_ps[range(self.batch_size), actions]  # log p(s_t, a_t; θonline)
+        log_ps_a = log_ps[range(batch_size), actions]  # log p(s_t, a_t; θonline)
 
         with torch.no_grad():
             # Calculate nth next state probabilities
@@ -62,7 +88,7 @@ class Agent():
             self.target_net.reset_noise()  # Sample new target net noise
             pns = self.target_net(next_states)  # Probabilities p(s_t+n, ·; θtarget)
             pns_a = pns[range(
-                self.batch_size), argmax_indices_ns]  # Double-Q probabilities p(s_t+n, argmax_a[(z, p(s_t+n, a; θonline))]; θtarget)
+                batch_size), argmax_indices_ns]  # Double-Q probabilities p(s_t+n, argmax_a[(z, p(s_t+n, a; θonline))]; θtarget)
 
             # Compute Tz (Bellman operator T applied to z)
             Tz = returns.unsqueeze(1) + nonterminals * (self.discount ** self.n) * self.support.unsqueeze(
@@ -76,21 +102,33 @@ class Agent():
             u[(l < (self.atoms - 1)) * (l == u)] += 1
 
             # Distribute probability of Tz
-            m = states.new_zeros(self.batch_size, self.atoms)
-            offset = torch.linspace(0, ((self.batch_size - 1) * self.atoms), self.batch_size).unsqueeze(1).expand(
-                self.batch_size, self.atoms).to(actions)
+            m = states.new_zeros(batch_size, self.atoms)
+            offset = torch.linspace(0, ((batch_size - 1) * self.atoms), batch_size).unsqueeze(1).expand(
+                batch_size, self.atoms).to(actions)
             m.view(-1).index_add_(0, (l + offset).view(-1),
                                   (pns_a * (u.float() - b)).view(-1))  # m_l = m_l + p(s_t+n, a*)(u - b)
             m.view(-1).index_add_(0, (u + offset).view(-1),
                                   (pns_a * (b - l.float())).view(-1))  # m_u = m_u + p(s_t+n, a*)(b - l)
 
-        loss = -torch.sum(m * log_ps_a, 1)  # Cross-entropy loss (minimises DKL(m||p(s_t, a_t)))
+        return -torch.sum(m * log_ps_a, 1)  # Cross-entropy loss (minimises DKL(m||p(s_t, a_t)))
+
+    def learn(self, mem):
+        # Sample transitions
+        idxs, states, actions, returns, next_states, nonterminals, weights = mem.sample(self.batch_size)
+
+        loss = self._loss(states, actions, returns, next_states, nonterminals)
         self.online_net.zero_grad()
         (weights * loss).mean().backward()  # Backpropagate importance-weighted minibatch loss
         self.optimiser.step()
+        self._refresh_quantized()
 
         mem.update_priorities(idxs, loss.detach().cpu().numpy())  # Update priorities of sampled transitions
 
+    # Initial priorities of transitions collected by an actor: their loss under the current networks, without learning
+    def priorities(self, states, actions, returns, next_states, nonterminals):
+        with torch.no_grad():
+            return self._loss(states, actions, returns, next_states, nonterminals).cpu().numpy()
+
     def update_target_net(self):
         self.target_net.load_state_dict(self.online_net.state_dict())
 
@@ -98,13 +136,72 @@ class Agent():
     def save(self, path):
         torch.save(self.online_net.state_dict(), os.path.join(path, 'model.pth'))
 
+    # Networks and optimiser state needed to resume training
+    def state_dict(self):
+        return {
+            'online_net': self.online_net.state_dict(),
+            'target_net': self.target_net.state_dict(),
+            'optimiser': self.optimiser.state_dict()
+        }
+
+    def load_state_dict(self, state_dict):
+        self.online_net.load_state_dict(state_dict['online_net'])
+        self.target_net.load_state_dict(state_dict['target_net'])
+        self.optimiser.load_state_dict(state_dict['optimiser'])
+        self._refresh_quantized(force=True)
+
     # Evaluates Q-value based on single state (no batch)
     def evaluate_q(self, state):
         with torch.no_grad():
             return (self.online_net(state.unsqueeze(0)) * self.support).sum(2).max(1)[0].item()
 
+    # Evaluates Q-values of a batch of states, batch_size states per forward pass
+    def evaluate_q_batch(self, states, batch_size=256):
+        with torch.no_grad():
+            return torch.cat([(self.online_net(states[i:i + batch_size]) * self.support).sum(2).max(1)[0]
+                              for i in range(0, len(states), batch_size)])
+
+    # Benchmarks batch-1 acting of the online net against its int8 copy and compares their greedy actions,
+    # the int8 copy being refreshed every update of steps_per_update acting steps
+    def quantization_report(self, states, n_runs=200, steps_per_update=1):
+        states = torch.stack(list(states))
+        quantized = QuantizedCopy(QuantizedDQN, self.online_net, calibration_size=len(states))
+        quantized.observe(states)
+        quantized_net = quantized.net
+
+        def latency(net):
+            with torch.no_grad():
+                start = time.perf_counter()
+                for i in range(n_runs):
+                    net(states[i % len(states)].unsqueeze(0))
+                return (time.perf_counter() - start) / n_runs
+
+        def size(net):
+            buffer = io.BytesIO()
+            torch.save(net.state_dict(), buffer)
+            return buffer.tell()
+
+        fp32_latency, int8_latency = latency(self.online_net), latency(quantized_net)
+
+        with torch.no_grad():
+            fp32_q = (self.online_net(states) * self.support).sum(2)
+            int8_q = (quantized_net(states) * self.support).sum(2)
+
+        return {
+            'fp32_latency_ms': fp32_latency * 1e3,
+            'int8_latency_ms': int8_latency * 1e3,
+            'speedup': fp32_latency / int8_latency,
+            **refresh_report(quantized, fp32_latency, int8_latency, steps_per_update),
+            'fp32_size_mb': size(self.online_net) / 2 ** 20,  # includes the noisy sigma parameters
+            'int8_size_mb': size(quantized_net) / 2 ** 20,
+            'greedy_agreement': (fp32_q.argmax(1) == int8_q.argmax(1)).float().mean().item(),
+            'mean_abs_q_error': (fp32_q - int8_q).abs().mean().item()
+        }
+
     def train(self):
         self.online_net.train()
+        self._refresh_quantized(force=True)  # Noisy weights again
 
     def eval(self):
         self.online_net.eval()
+        self._refresh_quantized(force=True)  # Mean weights of the noisy layers
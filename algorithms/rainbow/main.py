@@ -2,6 +2,9 @@ import argparse
 from datetime import datetime
 import numpy as np
 import torch
+import shutil
+import time
+import os
 
 from tqdm import tqdm
 
@@ -15,6 +18,7 @@ parser.add_argument('--T-max', type=int, default=int(50e5), metavar='STEPS',  #
 parser.add_argument('--max-episode-length', type=int, default=int(108e3), metavar='LENGTH',
                     help='Max episode length (0 to disable)')
 parser.add_argument('--history-length', type=int, default=4, metavar='T', help='Number of consecutive states processed')
+parser.add_argument('--encoder', type=str, default='nature', help='Convolution body (nature/impala/separable)')
 parser.add_argument('--hidden-size', type=int, default=512, metavar='SIZE', help='Network hidden size')
 parser.add_argument('--noisy-std', type=float, default=0.1, metavar='σ',
                     help='Initial standard deviation of noisy linear layers')
@@ -24,6 +28,12 @@ parser.add_argument('--V-max', type=float, default=10, metavar='V', help='Maximu
 parser.add_argument('--model', type=str, metavar='PARAMS', help='Pretrained model (state dict)')
 parser.add_argument('--memory-capacity', type=int, default=int(1e6), metavar='CAPACITY',
                     help='Experience replay memory capacity')
+parser.add_argument('--memory-path', type=str, default=None, metavar='PATH',
+                    help='Store the replay frames in a memory-mapped file at PATH instead of RAM')
+parser.add_argument('--memory-compress', action='store_true',
+                    help='Keep every replay frame zlib-compressed in RAM, batches only decompress the frames they use')
+parser.add_argument('--memory-benchmark', action='store_true',
+                    help='Benchmark the sample throughput of the disk-backed and compressed replay memories against the in-memory one')
 parser.add_argument('--replay-frequency', type=int, default=4, metavar='k', help='Frequency of sampling from memory')
 parser.add_argument('--priority-exponent', type=float, default=0.5, metavar='ω',
                     help='Prioritised experience replay exponent (originally denoted α)')
@@ -37,6 +47,16 @@ parser.add_argument('--reward-clip', type=int, default=1, metavar='VALUE', help=
 parser.add_argument('--lr', type=float, default=0.0000625, metavar='η', help='Learning rate')
 parser.add_argument('--adam-eps', type=float, default=1.5e-4, metavar='ε', help='Adam epsilon')
 parser.add_argument('--batch-size', type=int, default=32, metavar='SIZE', help='Batch size')
+parser.add_argument('--prefetch', type=int, default=0, metavar='K',
+                    help='Number of batches sampled ahead on a background thread (0 to sample synchronously)')
+parser.add_argument('--actors', type=int, default=0, metavar='N',
+                    help='Number of actor processes feeding a continuously training learner (0 to act and learn in one loop)')
+parser.add_argument('--envs', type=int, default=1, metavar='N',
+                    help='Number of envs stepped in lockstep with batched acting (without --actors)')
+parser.add_argument('--block-size', type=int, default=100, metavar='SIZE',
+                    help='Number of transitions each actor (or env of --envs) writes to the memory at once')
+parser.add_argument('--actor-sync-interval', type=int, default=400, metavar='STEPS',
+                    help='Number of steps between refreshes of the actor networks')
 parser.add_argument('--learn-start', type=int, default=int(80e3), metavar='STEPS',
                     help='Number of steps before starting training')
 parser.add_argument('--evaluate', action='store_true', help='Evaluate only')
@@ -46,27 +66,41 @@ parser.add_argument('--evaluation-episodes', type=int, default=10, metavar='N',
                     help='Number of evaluation episodes to average over')
 parser.add_argument('--evaluation-size', type=int, default=500, metavar='N',
                     help='Number of transitions to use for validating Q')
+parser.add_argument('--snapshot-path', type=str, default=None, metavar='PATH',
+                    help='Directory of the full training snapshot, training resumes from it if it exists')
+parser.add_argument('--snapshot-interval', type=int, default=int(25e4), metavar='STEPS',
+                    help='Number of training steps between snapshots (taken at the end of the next episode)')
+parser.add_argument('--snapshot-compress', action='store_true', help='Compress the replay frames of snapshots')
 parser.add_argument('--render', action='store_true', help='Display screen (testing only)')
+parser.add_argument('--quantize-act', action='store_true', help='Act with an int8 copy of the online network (CPU only)')
+parser.add_argument('--quantize-refresh', type=int, default=40, metavar='k',
+                    help='Number of updates of the online network (noise resets or optimiser steps) between requantizations '
+                         '(--quantize-report prints the break-even value)')
+parser.add_argument('--quantize-report', action='store_true',
+                    help='Benchmark the int8 acting network against the fp32 one on the validation memory')
 
 # Setup
 args = parser.parse_args()
 
 if args.wrapper == 'ale':
-    from env import Env
+    from .env import Env
     if args.game == 'gvgai-cec1-lvl0-v0':
         args.game = 'space_invaders'
 elif args.wrapper == 'gvgai':
-    from env_gvgai import Env
+    from .env_gvgai import Env
 elif args.wrapper == 'gym':
-    from env_gym import Env
+    from .env_gym import Env
     if args.game == 'gvgai-cec1-lvl0-v0':
         args.game = 'SpaceInvaders-v0'
 else:
     print('Please choose a wrapper from [ale, gvgai, gym]')
 
-from agent import Agent
-from memory import ReplayMemory
-from test import test
+from .agent import Agent
+from .memory import ReplayMemory, BlockBuilder, PrefetchingMemory, benchmark
+from .vec_env import VecEnv
+from .actor import start_actors, get_blocks, stop_actors, publish_weights
+from .test import test
+from . import test as test_module
 
 
 print('Options: ')
@@ -90,6 +124,44 @@ def log(s):
     print('[' + str(datetime.now().strftime('%Y-%m-%dT%H:%M:%S')) + '] ' + s)
 
 
+# Saves everything needed to resume training, to a temporary directory first so a preempted save never
+# corrupts the previous snapshot
+def save_snapshot(path, T):
+    tmp_path, old_path = path + '.tmp', path + '.old'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    torch.save({'T': T, 'agent': dqn.state_dict(), 'test': test_module.state_dict()},
+               os.path.join(tmp_path, 'training.pth'))
+    mem.save(os.path.join(tmp_path, 'memory'), compress=args.snapshot_compress)
+    val_mem.save(os.path.join(tmp_path, 'val_memory'))
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.isdir(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+# Restores a snapshot written by save_snapshot and returns its step count
+def load_snapshot(path):
+    if not os.path.isdir(path):
+        path = path + '.old'  # Preempted between the two renames of save_snapshot
+    state = torch.load(os.path.join(path, 'training.pth'), map_location='cpu')
+    dqn.load_state_dict(state['agent'])
+    test_module.load_state_dict(state['test'])
+    mem.load(os.path.join(path, 'memory'))
+    val_mem.load(os.path.join(path, 'val_memory'))
+    return state['T']
+
+
+# Whether T went past a multiple of interval since last_T
+def crossed(T, last_T, interval):
+    return T // interval > last_T // interval
+
+
+def snapshot_exists(path):
+    return path is not None and (os.path.isdir(path) or os.path.isdir(path + '.old'))
+
+
 print('')
 
 # Environment
@@ -100,34 +172,152 @@ print('Action Space Length: ' + str(action_space))
 
 # Agent
 dqn = Agent(args, env)
-mem = ReplayMemory(args, args.memory_capacity)
+mem = ReplayMemory(args, args.memory_capacity, path=args.memory_path, compress=args.memory_compress)
 priority_weight_increase = (1 - args.priority_weight) / (args.T_max - args.learn_start)
 
 # Construct validation memory
-print('Creating validation memory...')
 val_mem = ReplayMemory(args, args.evaluation_size)
-T, done = 0, True
-while T < args.evaluation_size:
-    if done:
-        state, done = env.reset(), False
-    # env.render()
-    next_state, _, done = env.step(np.random.randint(0, action_space))
-    val_mem.append(state, None, None, done)
-    state = next_state
-    T += 1
-print('Created validation memory.')
-
-if args.evaluate:
+T_start = 0
+if snapshot_exists(args.snapshot_path):
+    print('Resuming from snapshot...')
+    start = time.time()
+    T_start = load_snapshot(args.snapshot_path)
+    print('Resumed at T = ' + str(T_start) + ' in ' + '{0:.2f}'.format(time.time() - start) + 's.')
+else:
+    print('Creating validation memory...')
+    T, done = 0, True
+    while T < args.evaluation_size:
+        if done:
+            state, done = env.reset(), False
+        # env.render()
+        next_state, _, done = env.step(np.random.randint(0, action_space))
+        val_mem.append(state, 0, 0., done)  # actions and rewards are not used for validation
+        state = next_state
+        T += 1
+    print('Created validation memory.')
+
+if args.quantize_report:
+    print('Benchmarking int8 acting network...\n')
+    dqn.train()  # Report on the noisy weights used for acting during training
+    # Noise is reset and the online network trained every replay_frequency steps
+    for k, v in dqn.quantization_report(val_mem, steps_per_update=args.replay_frequency / 2).items():
+        print(' ' * 4 + k + ': ' + '{0:.4f}'.format(v))
+elif args.memory_benchmark:
+    print('Benchmarking replay memory backends...\n')
+    for k, v in benchmark(args, args.memory_capacity, frames=val_mem.frames,  # Game frames repeated over the memory
+                          directory=os.path.dirname(os.path.abspath(args.memory_path)) if args.memory_path else None).items():
+        print(' ' * 4 + k + ': ' + '{0:.4f}'.format(v))
+elif args.evaluate:
     print('Evaluating...\n')
     dqn.eval()  # Set DQN (online network) to evaluation mode
     avg_reward, avg_Q = test(args, 0, dqn, val_mem, evaluate=True)  # Test
     print('Avg. reward: ' + str(avg_reward) + ' | Avg. Q: ' + str(avg_Q))
+elif args.actors > 0:
+    # Learner loop, the actors play and compute initial priorities while the learner trains continuously
+    print('Training with ' + str(args.actors) + ' actors...\n')
+    dqn.train()
+    replay = PrefetchingMemory(mem, args.batch_size, args.prefetch) if args.prefetch > 0 else mem
+    actors, blocks, stop, weights = start_actors(args.actors, args, Env, dqn.online_net, block_size=args.block_size,
+                                                 sync_interval=args.actor_sync_interval)
+    progress = tqdm(initial=T_start, total=args.T_max)
+    T = T_start
+    while T < args.T_max:
+        last_T = T
+        for transitions, priorities, start, end in get_blocks(blocks, block=T < args.learn_start):
+            replay.append_batch(*transitions, priorities=priorities, start=start, end=end)
+            T += end - start  # Transitions sent for the first time, not the context of the block
+        progress.update(T - last_T)
+
+        if crossed(T, last_T, args.actor_sync_interval):
+            publish_weights(weights, dqn.online_net)
+
+        if T >= args.learn_start:
+            mem.priority_weight = min(mem.priority_weight + priority_weight_increase * (T - last_T),
+                                      1)  # Anneal importance sampling weight β to 1
+
+            dqn.reset_noise()  # Draw a new set of noisy weights
+            dqn.learn(replay)  # Train with n-step distributional double-Q learning
+
+            if crossed(T, last_T, args.evaluation_interval):
+                dqn.eval()  # Set DQN (online network) to evaluation mode
+                avg_reward, avg_Q = test(args, T, dqn, val_mem)  # Test
+                log('T = ' + str(T) + ' / ' + str(args.T_max) + ' | Avg. reward: ' + str(
+                    avg_reward) + ' | Avg. Q: ' + str(avg_Q) +
+                    (' | Memory compression: ' + '{0:.2f}'.format(mem.compression_ratio()) if args.memory_compress else ''))
+                dqn.train()  # Set DQN (online network) back to training mode
+
+            # Update target network
+            if crossed(T, last_T, args.target_update):
+                dqn.update_target_net()
+
+        if args.snapshot_path is not None and crossed(T, last_T, args.snapshot_interval):
+            save_snapshot(args.snapshot_path, T)  # Blocks are whole, the memory is consistent between them
+
+    progress.close()
+    stop_actors(actors, blocks, stop)
+    if replay is not mem:
+        replay.close()
+elif args.envs > 1:
+    # Training loop over envs in lockstep, every env writes its own blocks of transitions to the memory
+    print('Training on ' + str(args.envs) + ' envs...\n')
+    dqn.train()
+    replay = PrefetchingMemory(mem, args.batch_size, args.prefetch) if args.prefetch > 0 else mem
+    envs = VecEnv(Env, args, args.envs)
+    envs.train()
+    builders = [BlockBuilder(args.history_length, args.multi_step, args.block_size) for _ in range(args.envs)]
+    progress = tqdm(initial=T_start, total=args.T_max)
+    T, states = T_start, envs.reset()
+    while T < args.T_max:
+        last_T, T = T, T + args.envs
+
+        if crossed(T, last_T, args.replay_frequency):
+            dqn.reset_noise()  # Draw a new set of noisy weights
+
+        actions = dqn.act_batch(states)  # Choose actions greedily (with noisy weights) for all envs at once
+        next_states, rewards, dones = envs.step(actions)  # Step
+        for builder, state, action, reward, done in zip(builders, states, actions, rewards, dones):
+            if args.reward_clip > 0:
+                reward = max(min(reward, args.reward_clip), -args.reward_clip)  # Clip rewards
+            if builder.append(state, action, reward, done):
+                _, transitions, (start, end) = builder.pop()
+                replay.append_batch(*transitions, start=start, end=end)  # Append a block of transitions to memory
+        states = next_states
+        progress.update(args.envs)
+
+        # Train and test
+        if T >= args.learn_start:
+            mem.priority_weight = min(mem.priority_weight + priority_weight_increase * args.envs,
+                                      1)  # Anneal importance sampling weight β to 1
+
+            for _ in range(T // args.replay_frequency - last_T // args.replay_frequency):
+                dqn.learn(replay)  # Train with n-step distributional double-Q learning
+
+            if crossed(T, last_T, args.evaluation_interval):
+                dqn.eval()  # Set DQN (online network) to evaluation mode
+                avg_reward, avg_Q = test(args, T, dqn, val_mem)  # Test
+                log('T = ' + str(T) + ' / ' + str(args.T_max) + ' | Avg. reward: ' + str(
+                    avg_reward) + ' | Avg. Q: ' + str(avg_Q) +
+                    (' | Memory compression: ' + '{0:.2f}'.format(mem.compression_ratio()) if args.memory_compress else ''))
+                dqn.train()  # Set DQN (online network) back to training mode
+
+            # Update target network
+            if crossed(T, last_T, args.target_update):
+                dqn.update_target_net()
+
+        if args.snapshot_path is not None and crossed(T, last_T, args.snapshot_interval):
+            save_snapshot(args.snapshot_path, T)  # Blocks are whole, the memory is consistent between them
+
+    progress.close()
+    envs.close()
+    if replay is not mem:
+        replay.close()
 else:
     # Training loop
     print('Training...\n')
     dqn.train()
-    T, done = 0, True
-    for T in tqdm(range(args.T_max)):
+    T, done, snapshot_due = T_start, True, False
+    replay = PrefetchingMemory(mem, args.batch_size, args.prefetch) if args.prefetch > 0 else mem
+    for T in tqdm(range(T_start, args.T_max), initial=T_start, total=args.T_max):
         if done:
             state, done = env.reset(), False
 
@@ -138,7 +328,7 @@ else:
         next_state, reward, done = env.step(action)  # Step
         if args.reward_clip > 0:
             reward = max(min(reward, args.reward_clip), -args.reward_clip)  # Clip rewards
-        mem.append(state, action, reward, done)  # Append transition to memory
+        replay.append(state, action, reward, done)  # Append transition to memory
         T += 1
 
         # Train and test
@@ -147,19 +337,31 @@ else:
                                       1)  # Anneal importance sampling weight β to 1
 
             if T % args.replay_frequency == 0:
-                dqn.learn(mem)  # Train with n-step distributional double-Q learning
+                dqn.learn(replay)  # Train with n-step distributional double-Q learning
 
             if T % args.evaluation_interval == 0:
                 dqn.eval()  # Set DQN (online network) to evaluation mode
                 avg_reward, avg_Q = test(args, T, dqn, val_mem)  # Test
                 log('T = ' + str(T) + ' / ' + str(args.T_max) + ' | Avg. reward: ' + str(
-                    avg_reward) + ' | Avg. Q: ' + str(avg_Q))
+                    avg_reward) + ' | Avg. Q: ' + str(avg_Q) +
+                    (' | Memory compression: ' + '{0:.2f}'.format(mem.compression_ratio()) if args.memory_compress else ''))
                 dqn.train()  # Set DQN (online network) back to training mode
 
             # Update target network
             if T % args.target_update == 0:
                 dqn.update_target_net()
 
+        # Snapshot at episode ends, so a resumed run starts a new episode exactly like this one would have
+        if args.snapshot_path is not None:
+            snapshot_due = snapshot_due or T % args.snapshot_interval == 0
+            if snapshot_due and done:
+                save_snapshot(args.snapshot_path, T)
+                snapshot_due = False
+
         state = next_state
 
+    if replay is not mem:
+        replay.close()
+
 env.close()
+test_module.close()
@@ -1,69 +1,125 @@
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import collections
+import threading
+import tempfile
+import queue
 import torch
+import zlib
+import time
+import sys
+import os
 
-Transition = namedtuple('Transition', ('timestep', 'state', 'action', 'reward', 'nonterminal'))
-blank_trans = Transition(0, torch.zeros(84, 84, dtype=torch.uint8), None, 0, False)
+frame_shape = (84, 84)
 
 
-# Segment tree data structure where parent node values are sum/max of children node values
+# Segment tree data structure where parent node values are sum/min of children node values
 class SegmentTree:
     def __init__(self, size):
         self.index = 0
         self.size = size
         self.full = False  # Used to track actual capacity
-        self.sum_tree = np.zeros((2 * size - 1,),
+        self.tree_start = 2 ** (size - 1).bit_length() - 1  # Put all leaves on the last level of a complete tree
+        self.sum_tree = np.zeros((2 * self.tree_start + 1,),
                                  dtype=np.float32)  # Initialise fixed size tree with all (priority) zeros
-        self.data = np.array([None] * size)  # Wrap-around cyclic buffer
+        self.min_tree = np.full((2 * self.tree_start + 1,), np.inf,
+                                dtype=np.float32)  # Empty leaves never are the minimum
         self.max = 1  # Initial max value to return (1 = 1^ω)
 
-    # Propagates value up tree given a tree index
-    def _propagate(self, index, value):
-        parent = (index - 1) // 2
-        left, right = 2 * parent + 1, 2 * parent + 2
-        self.sum_tree[parent] = self.sum_tree[left] + self.sum_tree[right]
-        if parent != 0:
-            self._propagate(parent, value)
-
-    # Updates value given a tree index
-    def update(self, index, value):
-        self.sum_tree[index] = value  # Set new value
-        self._propagate(index, value)  # Propagate value
-        self.max = max(value, self.max)
+    # Recomputes the sum/min of the given nodes from their children
+    def _update_nodes(self, indices):
+        children = indices * 2 + np.expand_dims([1, 2], axis=1)
+        self.sum_tree[indices] = np.sum(self.sum_tree[children], axis=0)
+        self.min_tree[indices] = np.min(self.min_tree[children], axis=0)
+
+    # Propagates values up tree given tree indices, one level at a time (all leaves share a level)
+    def _propagate(self, indices):
+        while indices[0] != 0:
+            indices = np.unique((indices - 1) // 2)
+            self._update_nodes(indices)
 
-    def append(self, data, value):
-        self.data[self.index] = data  # Store data in underlying data structure
-        self.update(self.index + self.size - 1, value)  # Update tree
+    # Updates values given tree indices
+    def update(self, indices, values):
+        indices, values = np.asarray(indices), np.asarray(values)
+        self.sum_tree[indices] = values  # Set new values
+        self.min_tree[indices] = np.where(values > 0, values, np.inf)  # Leaves that are never sampled are not the minimum
+        self._propagate(indices)  # Propagate values
+        self.max = max(np.max(values), self.max)
+
+    def append(self, value):
+        self.update(np.array([self.index + self.tree_start]), np.array([value]))  # Update tree
         self.index = (self.index + 1) % self.size  # Update index
         self.full = self.full or self.index == 0  # Save when capacity reached
         self.max = max(value, self.max)
 
-    # Searches for the location of a value in sum tree
-    def _retrieve(self, index, value):
-        left, right = 2 * index + 1, 2 * index + 2
-        if left >= len(self.sum_tree):
-            return index
-        elif value <= self.sum_tree[left]:
-            return self._retrieve(left, value)
-        else:
-            return self._retrieve(right, value - self.sum_tree[left])
+    # Appends consecutive values at once (at most size of them)
+    def extend(self, values):
+        self.update((self.index + np.arange(len(values))) % self.size + self.tree_start, values)
+        self.full = self.full or self.index + len(values) >= self.size
+        self.index = (self.index + len(values)) % self.size
 
-    # Searches for a value in sum tree and returns value, data index and tree index
-    def find(self, value):
-        index = self._retrieve(0, value)  # Search for index of item from root
-        data_index = index - self.size + 1
-        return (self.sum_tree[index], data_index, index)  # Return value, data index, tree index
+    # Searches for the location of values in sum tree, descending one level at a time for the whole batch
+    def _retrieve(self, values):
+        indices = np.zeros(len(values), dtype=np.int64)
+        while indices[0] < self.tree_start:
+            left = 2 * indices + 1
+            left_values = self.sum_tree[left]
+            go_right = values > left_values
+            indices = left + go_right
+            values = values - go_right * left_values
+        return indices
 
-    # Returns data given a data index
-    def get(self, data_index):
-        return self.data[data_index % self.size]
+    # Searches for values in sum tree and returns values, data indices and tree indices
+    def find(self, values):
+        indices = self._retrieve(np.asarray(values, dtype=np.float32))  # Search for indices of items from root
+        data_indices = indices - self.tree_start
+        return (self.sum_tree[indices], data_indices, indices)  # Return values, data indices, tree indices
+
+    # Recomputes every internal node from the leaves, one level at a time
+    def rebuild(self):
+        start = self.tree_start
+        while start > 0:
+            start = (start - 1) // 2
+            self._update_nodes(np.arange(start, 2 * start + 1))
 
     def total(self):
         return self.sum_tree[0]
 
+    def min(self):
+        return self.min_tree[0]
+
+
+# Frame store keeping every frame zlib-compressed on its own, so a batch only decompresses the frames it needs
+class CompressedFrames:
+    def __init__(self, capacity, level=1):
+        self.level = level
+        self.data = [zlib.compress(np.zeros(frame_shape, dtype=np.uint8), level)] * capacity
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key, frames):
+        if isinstance(key, (slice, np.ndarray)):
+            for i, frame in zip(range(*key.indices(len(self.data))) if isinstance(key, slice) else key, frames):
+                self.data[i] = zlib.compress(np.ascontiguousarray(frame), self.level)
+        else:
+            self.data[key] = zlib.compress(np.ascontiguousarray(frames), self.level)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(len(self.data)))
+        idxs = np.asarray(key)
+        unique_idxs, inverse = np.unique(idxs, return_inverse=True)  # Frames shared by overlapping stacks are decompressed once
+        frames = np.frombuffer(b''.join([zlib.decompress(self.data[i]) for i in unique_idxs]), dtype=np.uint8)
+        return frames.reshape(-1, *frame_shape)[inverse.reshape(idxs.shape)]
+
+    # Bytes held by the first count compressed frames, including the header of each bytes object and its list slot
+    def compressed_size(self, count):
+        return sum(sys.getsizeof(data) for data in self.data[:count]) + count * np.dtype(np.intp).itemsize
+
 
 class ReplayMemory:
-    def __init__(self, args, capacity):
+    def __init__(self, args, capacity, path=None, compress=False):
         self.device = args.device
         self.capacity = capacity
         self.history = args.history_length
@@ -73,80 +129,193 @@ class ReplayMemory:
         self.priority_exponent = args.priority_exponent
         self.t = 0  # Internal episode timestep counter
         self.transitions = SegmentTree(
-            capacity)  # Store transitions in a wrap-around cyclic buffer within a sum tree for querying priorities
+            capacity)  # Sum tree over the priorities of the transitions, also tracking the cyclic buffer index
+        # Transitions are stored in a wrap-around cyclic buffer of parallel arrays, frames discretised to uint8
+        self.timesteps = np.zeros(capacity, dtype=np.int32)
+        self.path = path
+        if path is not None and compress:
+            raise ValueError("Frames are either memory-mapped or compressed, not both")
+        if compress:
+            self.frames = CompressedFrames(capacity)
+        elif path is None:
+            self.frames = np.zeros((capacity, *frame_shape), dtype=np.uint8)
+        else:  # Frames are the bulk of the memory, keep them in a file and let the OS page them in
+            self.frames = np.memmap(path, dtype=np.uint8, mode='w+', shape=(capacity, *frame_shape))
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.nonterminals = np.zeros(capacity, dtype=np.bool_)
 
     # Adds state and action at time t, reward and terminal at time t + 1
     def append(self, state, action, reward, terminal):
-        state = state[-1].mul(255).to(dtype=torch.uint8,
-                                      device=torch.device('cpu'))  # Only store last frame and discretise to save memory
-        self.transitions.append(Transition(self.t, state, action, reward, not terminal),
-                                self.transitions.max)  # Store new transition with maximum priority
+        index = self.transitions.index
+        self.timesteps[index] = self.t
+        self.frames[index] = state[-1].mul(255).to(dtype=torch.uint8, device=torch.device('cpu')).numpy()  # Only store last frame and discretise to save memory
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.nonterminals[index] = not terminal
+        self.transitions.append(self.transitions.max)  # Store new transition with maximum priority
         self.t = 0 if terminal else self.t + 1  # Start new episodes with t = 0
 
-    # Returns a transition with blank states where appropriate
-    def _get_transition(self, idx):
-        transition = np.array([None] * (self.history + self.n))
-        transition[self.history - 1] = self.transitions.get(idx)
-        for t in range(self.history - 2, -1, -1):  # e.g. 2 1 0
-            if transition[t + 1].timestep == 0:
-                transition[t] = blank_trans  # If future frame has timestep 0
-            else:
-                transition[t] = self.transitions.get(idx - self.history + 1 + t)
-        for t in range(self.history, self.history + self.n):  # e.g. 4 5 6
-            if transition[t - 1].nonterminal:
-                transition[t] = self.transitions.get(idx - self.history + 1 + t)
-            else:
-                transition[t] = blank_trans  # If prev (next) frame is terminal
-        return transition
-
-    # Returns a valid sample from a segment
-    def _get_sample_from_segment(self, segment, i):
-        valid = False
-        while not valid:
-            sample = np.random.uniform(i * segment,
-                                       (i + 1) * segment)  # Uniformly sample an element from within a segment
-            prob, idx, tree_idx = self.transitions.find(
-                sample)  # Retrieve sample from tree with un-normalised probability
-            # Resample if transition straddled current index or probablity 0
-            if (self.transitions.index - idx) % self.capacity > self.n and (
-                    idx - self.transitions.index) % self.capacity >= self.history and prob != 0:
-                valid = True  # Note that conditions are valid but extra conservative around buffer index 0
-
-        # Retrieve all required transition data (from t - h to t + n)
-        transition = self._get_transition(idx)
-        # Create un-discretised state and nth next state
-        state = torch.stack([trans.state for trans in transition[:self.history]]).to(dtype=torch.float32,
-                                                                                     device=self.device).div_(255)
-        next_state = torch.stack([trans.state for trans in transition[self.n:self.n + self.history]]).to(
-            dtype=torch.float32, device=self.device).div_(255)
-        # Discrete action to be used as index
-        action = torch.tensor([transition[self.history - 1].action], dtype=torch.int64, device=self.device)
-        # Calculate truncated n-step discounted return R^n = Σ_k=0->n-1 (γ^k)R_t+k+1 (note that invalid nth next states have reward 0)
-        R = torch.tensor([sum(self.discount ** n * transition[self.history + n - 1].reward for n in range(self.n))],
-                         dtype=torch.float32, device=self.device)
-        # Mask for non-terminal nth next states
-        nonterminal = torch.tensor([transition[self.history + self.n - 1].nonterminal], dtype=torch.float32,
-                                   device=self.device)
+    # Adds consecutive uint8 frames of a single stream of episodes (e.g. a block of a BlockBuilder) with their
+    # timesteps, at once. Only transitions start to end can be sampled, with the given initial priorities (before the
+    # priority exponent) or the maximum one, the others only provide history and n-step context
+    def append_batch(self, frames, timesteps, actions, rewards, nonterminals, priorities=None, start=0, end=None):
+        idxs = (self.transitions.index + np.arange(len(frames))) % self.capacity
+        self.timesteps[idxs] = timesteps
+        self.frames[idxs] = frames
+        self.actions[idxs] = actions
+        self.rewards[idxs] = rewards
+        self.nonterminals[idxs] = nonterminals
+        values = np.zeros(len(frames), dtype=np.float32)
+        values[start:end] = self.transitions.max if priorities is None else np.power(priorities, self.priority_exponent)
+        self.transitions.extend(values)
+        self.t = timesteps[-1] + 1 if nonterminals[-1] else 0
+
+    # Returns the buffer indices of transitions (from t - h + 1 to t + n) and the masks of their blank frames
+    def _get_transitions(self, idxs):
+        transition_idxs = (np.expand_dims(idxs, axis=1) + np.arange(-self.history + 1, self.n + 1)) % self.capacity
+        blank = np.zeros(transition_idxs.shape, dtype=np.bool_)
+        # If a future frame has timestep 0, e.g. 2 1 0
+        blank[:, :self.history - 1] = np.flip(np.cumsum(np.flip(self.timesteps[transition_idxs[:, 1:self.history]] == 0, axis=1), axis=1), axis=1) > 0
+        # If a prev (next) frame is terminal, e.g. 4 5 6
+        blank[:, self.history:] = np.cumsum(~self.nonterminals[transition_idxs[:, self.history - 1:-1]], axis=1) > 0
+        return transition_idxs, blank
+
+    # Returns the frames of the given buffer indices
+    def _get_frames(self, idxs):
+        if not isinstance(self.frames, np.memmap):
+            return self.frames[idxs]
+        # Read every needed frame once and in file order, so overlapping stacks share pages and reads stay sequential
+        unique_idxs, inverse = np.unique(idxs, return_inverse=True)
+        return self.frames[unique_idxs][inverse.reshape(idxs.shape)]
 
-        return prob, idx, tree_idx, state, action, R, next_state, nonterminal
+    # Returns valid samples, one from each of the batch_size segments of the priority sum
+    def _sample_proportional(self, batch_size):
+        segment = self.transitions.total() / batch_size  # Batch size number of segments, based on sum over all probabilities
+        segments = np.arange(batch_size)
+        probs, idxs, tree_idxs = [np.empty(batch_size, dtype=dtype) for dtype in (np.float32, np.int64, np.int64)]
+        while len(segments) > 0:
+            samples = np.random.uniform(segments * segment, (segments + 1) * segment)  # Uniformly sample an element from within each segment
+            probs[segments], idxs[segments], tree_idxs[segments] = self.transitions.find(samples)  # Retrieve samples from tree with un-normalised probability
+            # Resample if transition straddled current index or probablity 0
+            valid = np.logical_and.reduce([
+                (self.transitions.index - idxs[segments]) % self.capacity > self.n,
+                (idxs[segments] - self.transitions.index) % self.capacity >= self.history,
+                probs[segments] != 0
+            ])  # Note that conditions are valid but extra conservative around buffer index 0
+            segments = segments[~valid]
+        return probs, idxs, tree_idxs
 
     def sample(self, batch_size):
         p_total = self.transitions.total()  # Retrieve sum of all priorities (used to create a normalised probability distribution)
-        segment = p_total / batch_size  # Batch size number of segments, based on sum over all probabilities
-        batch = [self._get_sample_from_segment(segment, i) for i in range(batch_size)]  # Get batch of valid samples
-        probs, idxs, tree_idxs, states, actions, returns, next_states, nonterminals = zip(*batch)
-        states, next_states, = torch.stack(states), torch.stack(next_states)
-        actions, returns, nonterminals = torch.cat(actions), torch.cat(returns), torch.stack(nonterminals)
-        probs = np.array(probs, dtype=np.float32) / p_total  # Calculate normalised probabilities
+        probs, idxs, tree_idxs = self._sample_proportional(batch_size)  # Get batch of valid samples
+        # Retrieve all required transition data (from t - h to t + n) in one gather
+        transition_idxs, blank = self._get_transitions(idxs)
+        frames = self._get_frames(transition_idxs)
+        frames[blank] = 0
+        # Create un-discretised states and nth next states, both views of the window converted once
+        frames = torch.from_numpy(frames).to(device=self.device).to(dtype=torch.float32).div_(255)
+        states, next_states = frames[:, :self.history], frames[:, self.n:self.n + self.history]
+        # Discrete actions to be used as index
+        actions = torch.tensor(self.actions[idxs], dtype=torch.int64, device=self.device)
+        # Calculate truncated n-step discounted returns R^n = Σ_k=0->n-1 (γ^k)R_t+k+1 (note that invalid nth next states have reward 0)
+        rewards = np.where(blank, 0, self.rewards[transition_idxs])[:, self.history - 1:-1]
+        returns = torch.tensor(rewards @ (self.discount ** np.arange(self.n)), dtype=torch.float32, device=self.device)
+        # Mask for non-terminal nth next states
+        nonterminals = torch.tensor(self.nonterminals[transition_idxs[:, -1]] & ~blank[:, -1], dtype=torch.float32,
+                                    device=self.device).unsqueeze(1)
+        probs = probs / p_total  # Calculate normalised probabilities
         capacity = self.capacity if self.transitions.full else self.transitions.index
         weights = (capacity * probs) ** -self.priority_weight  # Compute importance-sampling weights w
-        weights = torch.tensor(weights / weights.max(), dtype=torch.float32,
-                               device=self.device)  # Normalise by max importance-sampling weight from batch
+        max_weight = (capacity * self.transitions.min() / p_total) ** -self.priority_weight  # Weight of the least likely transition
+        weights = torch.tensor(weights / max_weight, dtype=torch.float32,
+                               device=self.device)  # Normalise by max importance-sampling weight of the whole memory
         return tree_idxs, states, actions, returns, next_states, nonterminals, weights
 
     def update_priorities(self, idxs, priorities):
         priorities = np.power(priorities, self.priority_exponent)
-        [self.transitions.update(idx, priority) for idx, priority in zip(idxs, priorities)]
+        self.transitions.update(idxs, priorities)  # Whole batch at once
+
+    # Writes the filled part of the memory to a directory: small arrays in one npz, frames as a stream of chunks
+    def save(self, path, compress=False, chunk_size=2 ** 12):
+        os.makedirs(path, exist_ok=True)
+        filled = self.capacity if self.transitions.full else self.transitions.index
+        tree_start = self.transitions.tree_start
+        np.savez(os.path.join(path, 'memory.npz'),
+                 timesteps=self.timesteps[:filled],
+                 actions=self.actions[:filled],
+                 rewards=self.rewards[:filled],
+                 nonterminals=self.nonterminals[:filled],
+                 priorities=self.transitions.sum_tree[tree_start:tree_start + filled],
+                 capacity=self.capacity, index=self.transitions.index, full=self.transitions.full,
+                 max=self.transitions.max, t=self.t, priority_weight=self.priority_weight,
+                 compress=compress, chunk_size=chunk_size)
+
+        chunks = (self.frames[start:start + chunk_size] for start in range(0, filled, chunk_size))
+        with open(os.path.join(path, 'frames.bin'), 'wb') as f:
+            if not compress:
+                [f.write(chunk) for chunk in chunks]  # Raw bytes, no copies
+            else:
+                with ThreadPoolExecutor() as executor:  # zlib releases the GIL, chunks compress in parallel
+                    for data in executor.map(lambda chunk: zlib.compress(chunk, 1), chunks):
+                        f.write(len(data).to_bytes(8, 'little'))  # Length prefix of each compressed chunk
+                        f.write(data)
+
+    # Restores a memory written by save into this one (same capacity), frames are streamed straight into place
+    def load(self, path):
+        with np.load(os.path.join(path, 'memory.npz')) as state:
+            if int(state['capacity']) != self.capacity:
+                raise ValueError("Memory saved with capacity %d, not %d" % (int(state['capacity']), self.capacity))
+            filled = len(state['timesteps'])
+            self.timesteps[:filled] = state['timesteps']
+            self.actions[:filled] = state['actions']
+            self.rewards[:filled] = state['rewards']
+            self.nonterminals[:filled] = state['nonterminals']
+            self.transitions.sum_tree[:] = 0
+            self.transitions.min_tree[:] = np.inf
+            tree_start = self.transitions.tree_start
+            self.transitions.sum_tree[tree_start:tree_start + filled] = state['priorities']
+            self.transitions.min_tree[tree_start:tree_start + filled] = np.where(state['priorities'] > 0, state['priorities'], np.inf)
+            self.transitions.rebuild()
+            self.transitions.index, self.transitions.full = int(state['index']), bool(state['full'])
+            self.transitions.max = float(state['max'])
+            self.t, self.priority_weight = int(state['t']), float(state['priority_weight'])
+            compress, chunk_size = bool(state['compress']), int(state['chunk_size'])
+
+        with open(os.path.join(path, 'frames.bin'), 'rb') as f:
+            if not compress:
+                for start in range(0, filled, chunk_size):
+                    if isinstance(self.frames, np.ndarray):
+                        f.readinto(self.frames[start:start + chunk_size])
+                    else:
+                        size = min(chunk_size, filled - start) * np.prod(frame_shape)
+                        self.frames[start:start + chunk_size] = np.frombuffer(f.read(size), dtype=np.uint8).reshape(-1, *frame_shape)
+            else:
+                def read_chunks():
+                    for start in range(0, filled, chunk_size):
+                        yield start, f.read(int.from_bytes(f.read(8), 'little'))
+
+                def decompress(chunk):
+                    start, data = chunk
+                    frames = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(-1, *frame_shape)
+                    self.frames[start:start + len(frames)] = frames
+
+                with ThreadPoolExecutor() as executor:
+                    list(executor.map(decompress, read_chunks()))
+
+    # Size of the stored frames against uncompressed uint8 frames
+    def compression_ratio(self):
+        filled = self.capacity if self.transitions.full else self.transitions.index
+        if not isinstance(self.frames, CompressedFrames) or filled == 0:
+            return 1.
+        return filled * np.prod(frame_shape) / self.frames.compressed_size(filled)
+
+    # Returns every state stack of the memory as one (capacity, h, 84, 84) tensor, in iteration order
+    def states(self):
+        idxs, blank = self._get_transitions(np.arange(self.capacity))
+        frames = self._get_frames(idxs[:, :self.history])
+        frames[blank[:, :self.history]] = 0
+        return torch.from_numpy(frames).to(device=self.device).to(dtype=torch.float32).div_(255)
 
     # Set up internal state for iterator
     def __iter__(self):
@@ -158,16 +327,173 @@ class ReplayMemory:
         if self.current_idx == self.capacity:
             raise StopIteration
         # Create stack of states
-        state_stack = [None] * self.history
-        state_stack[-1] = self.transitions.data[self.current_idx].state
-        prev_timestep = self.transitions.data[self.current_idx].timestep
-        for t in reversed(range(self.history - 1)):
-            if prev_timestep == 0:
-                state_stack[t] = blank_trans.state  # If future frame has timestep 0
-            else:
-                state_stack[t] = self.transitions.data[self.current_idx + t - self.history + 1].state
-                prev_timestep -= 1
-        state = torch.stack(state_stack, 0).to(dtype=torch.float32, device=self.device).div_(
-            255)  # Agent will turn into batch
+        idxs, blank = self._get_transitions(np.array([self.current_idx]))
+        state_stack = torch.from_numpy(self._get_frames(idxs[0, :self.history]) * ~blank[0, :self.history, None, None])
+        state = state_stack.to(dtype=torch.float32, device=self.device).div_(255)  # Agent will turn into batch
         self.current_idx += 1
         return state
+
+
+class BlockBuilder:
+    """
+    Collects the transitions of one stream of episodes (an env or an actor) into blocks that ReplayMemory.append_batch
+    writes as is, even between blocks of other streams: block_size new transitions preceded by the h - 1 before them
+    and followed by the n after them. Those are written again but never sampled, so every transition keeps its full
+    history and n-step window.
+    """
+
+    def __init__(self, history, n, block_size):
+        self.history = history
+        self.n = n
+        self.block_size = block_size
+        self.pending, self.timesteps = [], []  # Transitions not written yet, after the context of the next block
+        self.context = 0
+        self.t = 0  # Episode timestep counter
+
+    # Adds state and action at time t, reward and terminal at time t + 1, returns whether a block is ready
+    def append(self, state, action, reward, terminal):
+        self.pending.append((state, action, reward, not terminal))
+        self.timesteps.append(self.t)
+        self.t = 0 if terminal else self.t + 1
+        return len(self.pending) == self.context + self.block_size + self.n
+
+    # Returns the states, the transitions for append_batch and the (start, end) range of new ones of the ready block
+    def pop(self):
+        states, actions, rewards, nonterminals = zip(*self.pending)
+        transitions = (
+            torch.stack([state[-1] for state in states]).mul(255).to(dtype=torch.uint8, device=torch.device('cpu')).numpy(),  # Last frames only
+            np.array(self.timesteps, dtype=np.int32),
+            np.array(actions, dtype=np.int64),
+            np.array(rewards, dtype=np.float32),
+            np.array(nonterminals, dtype=np.bool_)
+        )
+        start, end = self.context, len(self.pending) - self.n
+        # The last n transitions are the first of the next block, the h - 1 before them its context
+        keep = self.history - 1 + self.n
+        self.pending, self.timesteps, self.context = self.pending[-keep:], self.timesteps[-keep:], self.history - 1
+        return states, transitions, (start, end)
+
+
+class PrefetchingMemory:
+    """
+    Wraps a ReplayMemory so the next `prefetch` batches are sampled, stacked and moved to the device on a
+    background thread while the learner trains on the current one.
+    Appends and priority updates go through the wrapper and are applied on the calling thread, in order and under
+    the same lock as sampling. Updates of transitions overwritten since their batch was sampled are dropped.
+    """
+
+    def __init__(self, mem, batch_size, prefetch=2):
+        self.mem = mem
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.batches = queue.Queue(maxsize=prefetch)
+        self.appended = 0  # Transitions appended through the wrapper
+        self.sampled_at = collections.deque()  # Append count when each batch handed to the learner was sampled
+        self.running = False
+        self.thread = None
+
+    def _prefetch(self):
+        while self.running:
+            with self.lock:
+                batch = (self.appended, self.mem.sample(self.batch_size))
+            while self.running:
+                try:
+                    self.batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def append(self, state, action, reward, terminal):
+        with self.lock:
+            self.mem.append(state, action, reward, terminal)
+            self.appended += 1
+
+    def append_batch(self, *transitions, **kwargs):
+        with self.lock:
+            self.mem.append_batch(*transitions, **kwargs)
+            self.appended += len(transitions[0])
+
+    def sample(self, batch_size):
+        assert batch_size == self.batch_size, "Batches are prefetched with size %d" % self.batch_size
+        if self.thread is None:  # Started on the first sample, once the memory holds enough transitions
+            self.running = True
+            self.thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.thread.start()
+        appended, batch = self.batches.get()
+        self.sampled_at.append(appended)
+        return batch
+
+    def update_priorities(self, idxs, priorities):
+        appended = self.sampled_at.popleft()  # Batches are updated in the order they were sampled
+        with self.lock:
+            overwritten = min(self.appended - appended, self.mem.capacity)
+            data_idxs = idxs - self.mem.transitions.tree_start
+            keep = (data_idxs - self.mem.transitions.index + overwritten) % self.mem.capacity >= overwritten
+            if keep.any():
+                self.mem.update_priorities(idxs[keep], priorities[keep])
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.batches = queue.Queue(maxsize=self.batches.maxsize)  # Stale batches are sampled again on restart
+        self.sampled_at.clear()
+
+
+# Fills a memory with random episodes of length episode_length, bypassing append to build large buffers quickly.
+# Frames are random, or the given ones repeated over the whole memory
+def _fill(mem, episode_length=100, frames=None):
+    steps = np.arange(mem.capacity)
+    mem.timesteps[:] = steps % episode_length
+    mem.nonterminals[:] = steps % episode_length != episode_length - 1
+    mem.actions[:] = np.random.randint(0, 6, mem.capacity)
+    mem.rewards[:] = np.random.randint(-1, 2, mem.capacity)
+    for start in range(0, mem.capacity, 2 ** 16):  # Bounded chunks so filling a disk memory never needs its size in RAM
+        chunk = steps[start:start + 2 ** 16]
+        if frames is None:
+            mem.frames[start:start + 2 ** 16] = np.random.randint(0, 256, (len(chunk), *frame_shape), dtype=np.uint8)
+        else:
+            mem.frames[start:start + 2 ** 16] = frames[chunk % len(frames)]
+    mem.transitions.update(mem.transitions.tree_start + steps, np.random.uniform(0.1, 1, mem.capacity).astype(np.float32))
+    mem.transitions.full = True
+
+
+def benchmark(args, capacity, n_batches=200, directory=None, frames=None):
+    """
+    Sample throughput (batches/s) of the in-memory, disk-backed and compressed replay memories on the same data,
+    and the compression ratio of the frames. Pass real frames (e.g. those of the validation memory), random ones
+    are incompressible.
+    The disk file is dropped from the page cache before sampling where the OS allows it, so the disk numbers
+    start from those of a memory larger than RAM.
+    """
+
+    results = {}
+    for backend in ('ram', 'disk', 'compressed'):
+        path = None
+        if backend == 'disk':
+            handle, path = tempfile.mkstemp(suffix='.frames', dir=directory)
+            os.close(handle)
+        mem = ReplayMemory(args, capacity, path=path, compress=backend == 'compressed')
+        _fill(mem, frames=frames)
+
+        if path is not None:
+            mem.frames.flush()
+            if hasattr(os, 'posix_fadvise'):
+                with open(path, 'rb') as f:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        start = time.perf_counter()
+        for _ in range(n_batches):
+            mem.sample(args.batch_size)
+        results[backend + '_batches_per_s'] = n_batches / (time.perf_counter() - start)
+
+        if backend == 'compressed':
+            results['compression_ratio'] = mem.compression_ratio()
+        if path is not None:
+            del mem
+            os.remove(path)
+
+    results['disk_ram_ratio'] = results['disk_batches_per_s'] / results['ram_batches_per_s']
+    results['compressed_ram_ratio'] = results['compressed_batches_per_s'] / results['ram_batches_per_s']
+    return results
@@ -3,6 +3,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from ..encoders import make_encoder, output_size
+from ..quantized import QuantizedModel
+
 
 # Factorised NoisyLinear layer with bias
 class NoisyLinear(nn.Module):
@@ -37,12 +40,15 @@ class NoisyLinear(nn.Module):
         self.weight_epsilon.copy_(epsilon_out.ger(epsilon_in))
         self.bias_epsilon.copy_(epsilon_out)
 
-    def forward(self, input):
+    # Returns the weight and bias used by forward (noisy only in training mode)
+    def weight_bias(self):
         if self.training:
-            return F.linear(input, self.weight_mu + self.weight_sigma * self.weight_epsilon,
-                            self.bias_mu + self.bias_sigma * self.bias_epsilon)
+            return self.weight_mu + self.weight_sigma * self.weight_epsilon, self.bias_mu + self.bias_sigma * self.bias_epsilon
         else:
-            return F.linear(input, self.weight_mu, self.bias_mu)
+            return self.weight_mu, self.bias_mu
+
+    def forward(self, input):
+        return F.linear(input, *self.weight_bias())
 
 
 class DQN(nn.Module):
@@ -51,19 +57,16 @@ class DQN(nn.Module):
         self.atoms = args.atoms
         self.action_space = action_space
 
-        self.conv1 = nn.Conv2d(args.history_length, 32, 8, stride=4, padding=1)
-        self.conv2 = nn.Conv2d(32, 64, 4, stride=2)
-        self.conv3 = nn.Conv2d(64, 64, 3)
-        self.fc_h_v = NoisyLinear(3136, args.hidden_size, std_init=args.noisy_std)
-        self.fc_h_a = NoisyLinear(3136, args.hidden_size, std_init=args.noisy_std)
+        input_shape = (args.history_length, 84, 84)
+        self.conv = make_encoder(args.encoder, input_shape, stem_padding=1)
+        self.conv_out_size = output_size(self.conv, input_shape)  # 3136 for the nature encoder
+        self.fc_h_v = NoisyLinear(self.conv_out_size, args.hidden_size, std_init=args.noisy_std)
+        self.fc_h_a = NoisyLinear(self.conv_out_size, args.hidden_size, std_init=args.noisy_std)
         self.fc_z_v = NoisyLinear(args.hidden_size, self.atoms, std_init=args.noisy_std)
         self.fc_z_a = NoisyLinear(args.hidden_size, action_space * self.atoms, std_init=args.noisy_std)
 
     def forward(self, x, log=False):
-        x = F.relu(self.conv1(x))
-        x = F.relu(self.conv2(x))
-        x = F.relu(self.conv3(x))
-        x = x.view(-1, 3136)
+        x = self.conv(x).view(-1, self.conv_out_size)
         v = self.fc_z_v(F.relu(self.fc_h_v(x)))  # Value stream
         a = self.fc_z_a(F.relu(self.fc_h_a(x)))  # Advantage stream
         v, a = v.view(-1, 1, self.atoms), a.view(-1, self.action_space, self.atoms)
@@ -78,3 +81,37 @@ class DQN(nn.Module):
         for name, module in self.named_children():
             if 'fc' in name:
                 module.reset_noise()
+
+    # Models saved before the encoders were pluggable name the convolutions conv1, conv2 and conv3
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        legacy = {'conv1.': 'conv.0.', 'conv2.': 'conv.2.', 'conv3.': 'conv.4.'}
+        state_dict = {(legacy[k[:6]] + k[6:] if k[:6] in legacy else k): v for k, v in state_dict.items()}
+        return super().load_state_dict(state_dict, *args, **kwargs)
+
+
+# int8 copy of a DQN used for acting on CPU: static int8 convolutions and dynamic int8 linear layers
+# holding the current (noisy or mean) weights of the noisy layers
+class QuantizedDQN(QuantizedModel):
+    def __init__(self, dqn, calibration_states):
+        fcs = nn.ModuleDict({name: nn.Linear(module.in_features, module.out_features)
+                             for name, module in dqn.named_children() if 'fc' in name})
+        with torch.no_grad():
+            for name, fc in fcs.items():
+                weight, bias = getattr(dqn, name).weight_bias()
+                fc.weight.copy_(weight)
+                fc.bias.copy_(bias)
+        super().__init__(dqn.conv, fcs)
+        self.atoms = dqn.atoms
+        self.action_space = dqn.action_space
+        self.quantize(calibration_states)
+
+    def forward(self, x):
+        x = self.features(x)
+        v = self.heads['fc_z_v'](F.relu(self.heads['fc_h_v'](x)))  # Value stream
+        a = self.heads['fc_z_a'](F.relu(self.heads['fc_h_a'](x)))  # Advantage stream
+        v, a = v.view(-1, 1, self.atoms), a.view(-1, self.action_space, self.atoms)
+        return F.softmax(v + a - a.mean(1, keepdim=True), dim=2)  # Probabilities with action over second dimension
+
+    # Requantizes the current weights of a DQN (call after every optimiser step or noise reset)
+    def refresh(self, dqn):
+        self.requantize(dqn.conv, [getattr(dqn, name).weight_bias() for name in self.heads])
@@ -7,23 +7,28 @@ import time
 
 # Globals
 Ts, rewards, Qs, best_avg_reward = [], [], [], -1e10
+# Evaluation env and validation states, created on the first test and reused by the next ones
+env, val_states, val_states_mem = None, None, None
 
 
 # Test DQN
 def test(args, T, dqn, val_mem, evaluate=False):
-    global Ts, rewards, Qs, best_avg_reward
-
-    if args.wrapper == 'ale':
-        from env import Env
-        if args.game == 'gvgai-cec1-lvl0-v0':
-            args.game = 'space_invaders'
-    elif args.wrapper == 'gvgai':
-        from env_gvgai import Env
-    else:
-        print('Please choose a wrapper from [ale, gvgai]')  # TODO add gym wrapper
-
-    env = Env(args)
-    env.eval()
+    global Ts, rewards, Qs, best_avg_reward, env, val_states, val_states_mem
+
+    if env is None:
+        if args.wrapper == 'ale':
+            from env import Env
+            if args.game == 'gvgai-cec1-lvl0-v0':
+                args.game = 'space_invaders'
+        elif args.wrapper == 'gvgai':
+            from env_gvgai import Env
+        else:
+            print('Please choose a wrapper from [ale, gvgai]')  # TODO add gym wrapper
+
+        env = Env(args)
+        env.eval()
+    if val_states_mem is not val_mem:
+        val_states, val_states_mem = val_mem.states(), val_mem  # Validation states stacked once into one tensor
     Ts.append(T)
     T_rewards, T_Qs = [], []
 
@@ -44,11 +49,9 @@ def test(args, T, dqn, val_mem, evaluate=False):
             if done:
                 T_rewards.append(reward_sum)
                 break
-    env.close()
 
-    # Test Q-values over validation memory
-    for state in val_mem:  # Iterate over valid states
-        T_Qs.append(dqn.evaluate_q(state))
+    # Test Q-values over validation memory, in batches
+    T_Qs = dqn.evaluate_q_batch(val_states).tolist()
 
     avg_reward, avg_Q = sum(T_rewards) / len(T_rewards), sum(T_Qs) / len(T_Qs)
     if not evaluate:
@@ -69,6 +72,30 @@ def test(args, T, dqn, val_mem, evaluate=False):
     return avg_reward, avg_Q
 
 
+# Closes the evaluation env
+def close():
+    global env
+    if env is not None:
+        env.close()
+        env = None
+
+
+# Results so far, saved with training snapshots so a resumed run keeps its plots and best model
+def state_dict():
+    return {
+        'Ts': list(Ts),
+        'rewards': [[float(r) for r in T_rewards] for T_rewards in rewards],
+        'Qs': [list(T_Qs) for T_Qs in Qs],
+        'best_avg_reward': float(best_avg_reward)
+    }
+
+
+def load_state_dict(state_dict):
+    global Ts, rewards, Qs, best_avg_reward
+    Ts, rewards, Qs = state_dict['Ts'], state_dict['rewards'], state_dict['Qs']
+    best_avg_reward = state_dict['best_avg_reward']
+
+
 # Plots min, max and mean + standard deviation bars of a population over time
 def _plot_line(xs, ys_population, title, path=''):
     max_colour, mean_colour, std_colour, transparent = 'rgb(0, 132, 180)', 'rgb(0, 172, 237)', 'rgba(29, 202, 255, 0.2)', 'rgba(0, 0, 0, 0)'
@@ -0,0 +1,43 @@
+import copy
+import torch
+
+
+class VecEnv:
+    """
+    Steps n_envs envs of env_class in lockstep in this process, stacking their states into one batch.
+    Every env gets its own seed. Envs whose episode ended are reset inside step, so the returned states are always
+    the ones to act on next.
+    """
+
+    def __init__(self, env_class, args, n_envs):
+        self.envs = []
+        for i in range(n_envs):
+            env_args = copy.copy(args)
+            env_args.seed = args.seed + i
+            self.envs.append(env_class(env_args))
+
+    def reset(self):
+        return torch.stack([env.reset() for env in self.envs])
+
+    def step(self, actions):
+        states, rewards, dones = [], [], []
+        for env, action in zip(self.envs, actions):
+            state, reward, done = env.step(action)
+            if done:
+                state = env.reset()
+            states.append(state)
+            rewards.append(reward)
+            dones.append(done)
+        return torch.stack(states), rewards, dones
+
+    def train(self):
+        [env.train() for env in self.envs]
+
+    def eval(self):
+        [env.eval() for env in self.envs]
+
+    def action_space(self):
+        return self.envs[0].action_space()
+
+    def close(self):
+        [env.close() for env in self.envs]
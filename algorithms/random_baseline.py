@@ -0,0 +1,227 @@
+import torch.multiprocessing as mp
+import numpy as np
+import collections
+import logging
+import json
+import time
+import os
+
+
+class Worker(mp.Process):
+    def __init__(
+        self,
+        worker_name,
+        env_factory,
+        res_queue,
+        global_ep_counter,
+        max_eps=100,
+        max_length=1000,
+        render=False):
+
+        super(Worker, self).__init__()
+
+        # local worker config
+        self.name = 'w%i' % worker_name
+        self.logprefix = "\033[0;1mWorker %s:\033[0m " % self.name
+        self.env_factory = env_factory
+        self.render = render
+        self.max_eps = max_eps  # max episodes of all workers
+        self.max_length = max_length
+        self.global_ep_counter = global_ep_counter
+        self.res_queue = res_queue  # shared queue to store results
+
+    def run(self):
+        # the environment is created here so every worker boots its emulator in parallel
+        logging.info(self.logprefix + "Instantiating environment...")
+        env = self.env_factory()
+
+        while True:
+            # reserve an episode before playing it so we never play more than max_eps
+            with self.global_ep_counter.get_lock():
+                if self.global_ep_counter.value >= self.max_eps:
+                    break
+                self.global_ep_counter.value += 1
+
+            env.reset()
+            episode_reward = 0.
+            episode_step = 0
+            terminal = False
+            while not terminal and episode_step < self.max_length:
+                if self.render and self.name == 'w0':
+                    env.render()
+
+                _, reward, terminal, _ = env.step(env.sample_action())
+                episode_reward += reward
+                episode_step += 1
+
+            self.res_queue.put({
+                "worker_name": self.name,
+                "level": env.name,
+                "reward": float(episode_reward),
+                "episode_length": episode_step
+            })
+
+        env.close()
+        self.res_queue.put(None)
+
+
+class RandomBaseline:
+    """
+    Collects random agent statistics without building any network.
+    Per-level reward and episode length histograms are cached in
+    <save_load_path>/Random_<game_id>.json and reused while they cover max_eps episodes.
+    """
+
+    def __init__(
+        self,
+        env_factory,
+        game_id,
+        save_load_path = "trained_models",
+        skip_load = False,
+        render = False,
+        n_workers = mp.cpu_count(),
+        checkpoint_interval = 50,
+        max_eps = 100,
+        max_length = 1000):
+
+        self.name = "Random"
+        self.logprefix = "\033[0;1mRandom Baseline: \033[0m"
+        self.env_factory = env_factory
+        self.env_name = game_id  # to save/load
+        self.save_load_path = save_load_path
+        self.skip_load = skip_load
+        self.checkpoint_interval = checkpoint_interval
+        self.max_eps = max_eps
+        self.episode = 0
+
+        # level -> histograms of rewards and episode lengths
+        self.levels = {}
+
+        self.global_ep_counter = mp.Value('i', 0)
+        self.res_queue = mp.Queue()  # queue to receive workers statistics
+
+        factories = env_factory if type(env_factory) is list else [env_factory]
+        self.workers = [
+            Worker(
+                worker_name=i,
+                # spread the levels evenly among the workers
+                env_factory = factories[i % len(factories)],
+                res_queue = self.res_queue,
+                global_ep_counter = self.global_ep_counter,
+                max_eps = max_eps,
+                max_length = max_length,
+                render = render
+            ) for i in range(max(n_workers, 1))
+        ]
+
+    def path(self):
+        return os.path.join(self.save_load_path, self.name + '_' + self.env_name + '.json')
+
+    def run(self):
+        if not self.skip_load and self.load():
+            if self.episode >= self.max_eps:
+                logging.info(self.logprefix + "Using cached baseline from %s." % self.path())
+                self.summary()
+                return self.levels
+
+        # cached episodes are kept, only the missing ones are played
+        self.global_ep_counter.value = self.episode
+        time_start_run = time.time()
+
+        logging.info(self.logprefix + "Running workers")
+
+        [w.start() for w in self.workers]
+
+        finished_workers = 0
+        while finished_workers < len(self.workers):
+            r = self.res_queue.get()
+            if r is None:
+                finished_workers += 1
+                continue
+
+            self.episode += 1
+            self.add(r["level"], r["reward"], r["episode_length"])
+
+            logging.info(
+                self.logprefix +
+                "Episode: " + str(self.episode) + "  |  " +
+                "Time elapsed: " + time.strftime("%H:%M:%S", time.gmtime(time.time() - time_start_run)) + "  |  " +
+                r["worker_name"] + " " + r["level"] + "  |  " +
+                "Reward: " + "{0:.2f}".format(r["reward"])
+            )
+
+            if self.episode % self.checkpoint_interval == 0:
+                self.save()
+
+        [w.join() for w in self.workers]
+
+        self.save()
+        self.summary()
+        return self.levels
+
+    def add(self, level, reward, episode_length):
+        if level not in self.levels:
+            self.levels[level] = {
+                "episodes": 0,
+                "reward": collections.Counter(),
+                "episode_length": collections.Counter()
+            }
+
+        stats = self.levels[level]
+        stats["episodes"] += 1
+        stats["reward"][repr(reward)] += 1  # json keys must be strings
+        stats["episode_length"][str(episode_length)] += 1
+
+    def save(self):
+        if not os.path.isdir(self.save_load_path):
+            os.makedirs(self.save_load_path)
+
+        state = {
+            'game': self.env_name,
+            'episode': self.episode,
+            'levels': self.levels
+        }
+
+        # write to a temporary file first so a killed run never leaves a corrupted cache
+        with open(self.path() + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path() + '.tmp', self.path())
+
+        logging.info(self.logprefix + "Baseline %d saved to %s." % (self.episode, self.path()))
+
+    def load(self):
+        if not os.path.isfile(self.path()):
+            return False
+
+        with open(self.path(), 'r') as f:
+            state = json.load(f)
+
+        self.episode = state['episode']
+        self.levels = {
+            level: {
+                "episodes": stats["episodes"],
+                "reward": collections.Counter(stats["reward"]),
+                "episode_length": collections.Counter(stats["episode_length"])
+            } for level, stats in state['levels'].items()
+        }
+
+        logging.info(self.logprefix + "Baseline loaded from %s." % self.path())
+        return True
+
+    def summary(self):
+        for level, stats in sorted(self.levels.items()):
+            rewards = np.array([float(k) for k in stats["reward"].keys()])
+            reward_counts = np.array(list(stats["reward"].values()))
+            lengths = np.array([int(k) for k in stats["episode_length"].keys()])
+            length_counts = np.array(list(stats["episode_length"].values()))
+
+            reward_mean = np.average(rewards, weights=reward_counts)
+            reward_std = np.sqrt(np.average((rewards - reward_mean) ** 2, weights=reward_counts))
+
+            logging.info(
+                self.logprefix + level + "  |  " +
+                "Episodes: " + str(stats["episodes"]) + "  |  " +
+                "Reward mean: " + "{0:.2f}".format(reward_mean) + "  |  " +
+                "Reward std: " + "{0:.2f}".format(reward_std) + "  |  " +
+                "Length mean: " + "{0:.2f}".format(np.average(lengths, weights=length_counts))
+            )
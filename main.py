@@ -21,8 +21,20 @@ if __name__ == "__main__":
     parser.add_argument('--cuda', action='store_true', help='Enable cuda')
     parser.add_argument('--log', type=int, default=logging.INFO, help='Logging level')
     parser.add_argument('--play', action='store_true', help='Play game')
-    parser.add_argument('--random', action='store_true', help='Play with random agent')
+    parser.add_argument('--random', action='store_true', help='Collect a random agent baseline (no network is built)')
+    parser.add_argument('--baseline-episodes', type=int, default=100, help='Number of episodes of the random agent baseline')
     parser.add_argument('--game-plays', type=int, default=5, help='Number of game plays')
+    parser.add_argument('--quantize', action='store_true', help='Act with an int8 copy of the network on workers and play (a3c_conv)')
+    parser.add_argument('--quantize-refresh', type=int, default=10, help='Synchronizations between requantizations of the int8 acting network, see --quantize-report for the break-even value (a3c_conv)')
+    parser.add_argument('--quantize-report', action='store_true', help='Benchmark the int8 acting network against the fp32 one (a3c_conv)')
+    parser.add_argument('--fused-heads', action='store_true', help='Compute both hidden head layers with a single Linear (a3c_conv/a2c)')
+    parser.add_argument('--encoder', type=str, default=None, help='Network body: nature/impala/separable (a3c_conv, default nature) or mlp (a3c, default none; es picks from the observations)')
+    parser.add_argument('--encoder-report', action='store_true', help='Report parameters, FLOPs and CPU latency of every encoder for this game')
+    parser.add_argument('--generations', type=int, default=1000, help='Number of generations (es)')
+    parser.add_argument('--population', type=int, default=50, help='Candidates evaluated per generation (es)')
+    parser.add_argument('--sigma', type=float, default=0.02, help='Standard deviation of the parameter noise (es)')
+    parser.add_argument('--lr', type=float, default=0.01, help='Learning rate (es)')
+    parser.add_argument('--antithetic', action='store_true', help='Evaluate every noise draw as +eps and -eps (es)')
     parser.add_argument('--checkpoint-interval', type=int, default=50, help='Number of episode between each checkpoint')
 
     # Setup
@@ -58,6 +70,43 @@ if __name__ == "__main__":
             Env.factory("gvgai-cec3-lvl0-v0"), Env.factory("gvgai-cec3-lvl1-v0")
         ]
 
+    if args.random:
+
+        from algorithms.random_baseline import RandomBaseline
+
+        baseline = RandomBaseline(
+            env_factory = factory or Env.factory(args.game),
+            game_id = args.game,
+            save_load_path = args.save_load_path,
+            skip_load = args.skip_load,
+            render = args.render,
+            n_workers = args.workers,
+            checkpoint_interval = args.checkpoint_interval,
+            max_eps = args.baseline_episodes,
+            max_length = args.max_length
+        )
+        baseline.run()
+        sys.exit(0)
+
+    if args.encoder_report:
+
+        from algorithms.encoders import report
+
+        env = (factory[0] if factory else Env.factory(args.game))()
+        input_shape = env.reset().shape
+        env.close()
+
+        logging.info("Encoders for input shape " + str(input_shape))
+        for row in report(input_shape):
+            logging.info(
+                row["encoder"].ljust(10) + "  |  " +
+                "Params: " + str(row["params"]) + "  |  " +
+                "MFLOPs: " + "{0:.2f}".format(row["flops"] / 1e6) + "  |  " +
+                "Features: " + str(row["features"]) + "  |  " +
+                "Latency: " + "{0:.3f}".format(row["latency_ms"]) + " ms"
+            )
+        sys.exit(0)
+
     if args.play:
         args.workers = 0  # it won't be a parallel worker
 
@@ -76,7 +125,8 @@ if __name__ == "__main__":
             update_global_delay = args.update_global_delay,
             checkpoint_interval = args.checkpoint_interval,
             max_eps = args.max_eps,
-            max_length = args.max_length
+            max_length = args.max_length,
+            encoder = args.encoder
         )
 
         if args.play:
@@ -103,10 +153,15 @@ if __name__ == "__main__":
             checkpoint_interval = args.checkpoint_interval,
             max_eps = args.max_eps,
             max_length = args.max_length,
-            random = args.random
+            quantize = args.quantize,
+            quantize_refresh = args.quantize_refresh,
+            fused_heads = args.fused_heads,
+            encoder = args.encoder or 'nature'
         )
 
-        if args.play:
+        if args.quantize_report:
+            a3c.quantization_report()
+        elif args.play:
             a3c.play(args.game_plays)
         else:
             try:
@@ -127,6 +182,33 @@ if __name__ == "__main__":
             cuda = args.cuda,
             gamma = args.gamma,
             max_eps = args.max_eps,
-            max_length = args.max_length
+            max_length = args.max_length,
+            fused_heads = args.fused_heads
         )
-        a2c.run()
\ No newline at end of file
+        a2c.run()
+
+    elif args.model == 'es':
+
+        from algorithms.es import ES
+
+        es = ES(
+            env_factory = factory or Env.factory(args.game),
+            play = args.play,
+            save_load_path = args.save_load_path,
+            skip_load = args.skip_load,
+            render = args.render,
+            n_workers = args.workers,
+            checkpoint_interval = args.checkpoint_interval,
+            generations = args.generations,
+            max_length = args.max_length,
+            population_size = args.population,
+            sigma = args.sigma,
+            learning_rate = args.lr,
+            antithetic = args.antithetic,
+            encoder = args.encoder
+        )
+
+        if args.play:
+            es.play(args.game_plays)
+        else:
+            es.run()
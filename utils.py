@@ -39,4 +39,13 @@ class SharedRMSprop(torch.optim.RMSprop):
 def np_torch_wrap(np_array, dtype=np.float32):
     if np_array.dtype != dtype:
         np_array = np_array.astype(dtype)
-    return torch.from_numpy(np_array)
\ No newline at end of file
+    return torch.from_numpy(np_array)
+
+def quantize_weight(weight, observer):
+    # Quantizes a float weight with the scheme of a quantization weight observer
+    weight = weight.detach().contiguous()
+    observer(weight)
+    scale, zero_point = observer.calculate_qparams()
+    if observer.qscheme in (torch.per_channel_symmetric, torch.per_channel_affine):
+        return torch.quantize_per_channel(weight, scale.double(), zero_point.long(), observer.ch_axis, observer.dtype)
+    return torch.quantize_per_tensor(weight, float(scale), int(zero_point), observer.dtype)